@@ -0,0 +1,210 @@
+import gc
+import numpy as np
+
+from db_store import Reports
+from sqlalchemy import extract, func, select
+from time_range import MAX_SHIFTS
+from typing import List, NamedTuple
+
+
+#
+# Аналитика отчетов магазинов
+#
+# Отчеты за период загружаются в столбцы NumPy (по магазину и дате),
+# все расчеты по магазинам выполняются над массивами целиком, без циклов
+# по отчетам: год данных сотен магазинов считается за доли секунды.
+#
+
+# Строк в одной части загрузки из БД
+CHUNK_ROWS = 5000
+
+# Окно скользящего среднего продаж, дни
+ROLLING_DAYS = 7
+# Порог модифицированной z-оценки дневных продаж (по медиане и MAD)
+SALES_Z_LIMIT = 3.5
+# Допустимое расхождение остатков с продажами: доля продаж, но не меньше MIN_DELTA
+INVENTORY_TOLERANCE = 0.2
+INVENTORY_MIN_DELTA = 1
+# Сколько последних выбросов показываем
+MAX_OUTLIERS = 20
+
+
+# Отчеты за период по столбцам, отсортированы по магазину и дате
+class ReportArrays(NamedTuple):
+    # Названия магазинов, store - номер магазина в этом массиве
+    stores: np.ndarray
+    store: np.ndarray
+    date: np.ndarray
+    shift: np.ndarray
+    sales: np.ndarray
+    remainings: np.ndarray
+
+
+# Динамика продаж магазина
+class StoreTrend(NamedTuple):
+    store: str
+    # Продажи за последние 7 дней и за 7 дней до них
+    week: int
+    previous_week: int
+    # Продажи последней смены магазина и той же смены неделю назад
+    shift_sales: int
+    last_week_shift_sales: int
+    # Скользящее среднее дневных продаж на последний день
+    average: float
+
+
+# Выброс: необычные дневные продажи или остатки, не сходящиеся с продажами
+class Outlier(NamedTuple):
+    store: str
+    date: np.datetime64
+    kind: str
+    value: int
+    expected: float
+
+
+class Analysis(NamedTuple):
+    trends: List[StoreTrend]
+    outliers: List[Outlier]
+
+
+# Изменение в процентах, None если сравнивать не с чем
+def percent_change(value, previous):
+    if not previous:
+        return None
+    return (value - previous) / previous * 100
+
+
+# Загружаем отчеты за период [start, end) в столбцы.
+# archive - сессия архивной БД: ее отчеты старше, поэтому читаются первыми
+async def load_reports(db, start, end, chunk_rows=CHUNK_ROWS, archive=None):
+
+    # Дата - секундами от 1970 года: БД отдает число, без разбора строк дат в Python.
+    # Порядок по дате дает индекс ix_reports_date, по магазинам сортируем уже массивы
+    query = (select(func.coalesce(Reports.store, ""),
+                    extract("epoch", Reports.date),
+                    Reports.bucket,
+                    func.coalesce(Reports.sales, 0),
+                    func.coalesce(Reports.remainings, 0)
+                    )
+             .where(Reports.date >= start, Reports.date < end)
+             .order_by(Reports.date, Reports.reports_id)
+             .execution_options(yield_per=chunk_rows)
+             )
+
+    columns = ([], [], [], [], [])
+
+    # Строки выборки не образуют циклов ссылок, а полные проходы сборщика мусора
+    # по куче процесса на сотнях тысяч строк занимают больше времени, чем само чтение
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for source in (archive, db):
+            if source is None:
+                continue
+            result = await source.stream(query)
+            try:
+                async for rows in result.partitions():
+                    for column, values in zip(columns, zip(*rows)):
+                        column.extend(values)
+            finally:
+                await result.close()
+    finally:
+        if collecting:
+            gc.enable()
+
+    names, dates, buckets, sales, remainings = columns
+    stores, store = np.unique(np.array(names, dtype=object), return_inverse=True)
+    # Устойчивая сортировка сохраняет порядок по дате внутри магазина
+    order = np.argsort(store, kind="stable")
+
+    return ReportArrays(stores=stores,
+                        store=store.astype(np.int64)[order],
+                        date=np.array(dates, dtype=np.int64).astype("datetime64[s]")[order],
+                        shift=(np.array([bucket or 0 for bucket in buckets], dtype=np.int64) % MAX_SHIFTS)[order],
+                        sales=np.array(sales, dtype=np.int64)[order],
+                        remainings=np.array(remainings, dtype=np.int64)[order],
+                        )
+
+
+# Суммы по магазинам и ячейкам (дням или сменам): матрица магазины x ячейки
+def grouped_sum(store, cell, cells, stores, weights=None):
+    counts = np.bincount(store * cells + cell, weights=weights, minlength=stores * cells)
+    return counts.reshape(stores, cells)
+
+
+# Скользящее среднее по строкам матрицы (для первых дней - по имеющимся)
+def rolling_average(matrix, window=ROLLING_DAYS):
+    total = np.cumsum(matrix, axis=1, dtype=np.float64)
+    total[:, window:] = total[:, window:] - total[:, :-window]
+    sizes = np.minimum(np.arange(1, matrix.shape[1] + 1), window)
+    return total / sizes
+
+
+# Модифицированная z-оценка по строкам с пропусками (NaN).
+# Если больше половины значений совпадает (MAD = 0), масштаб берем по среднему отклонению
+def robust_z(matrix):
+    median = np.nanmedian(matrix, axis=1, keepdims=True)
+    deviation = np.abs(matrix - median)
+    mad = np.nanmedian(deviation, axis=1, keepdims=True) / 0.6745
+    mean_ad = np.nanmean(deviation, axis=1, keepdims=True) * 1.253314
+    scale = np.where(mad > 0, mad, mean_ad)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(scale > 0, (matrix - median) / scale, 0.0)
+
+
+# Анализ отчетов за период, который начинается в день start и длится days дней
+def analyse(arrays, start, days, rolling_days=ROLLING_DAYS, z_limit=SALES_Z_LIMIT,
+            tolerance=INVENTORY_TOLERANCE, min_delta=INVENTORY_MIN_DELTA, max_outliers=MAX_OUTLIERS):
+
+    stores = len(arrays.stores)
+    if stores == 0:
+        return Analysis([], [])
+
+    first_day = np.datetime64(start, "D")
+    day = (arrays.date.astype("datetime64[D]") - first_day).astype(np.int64)
+    shifts = int(arrays.shift.max()) + 1
+
+    # Дневные продажи и количество отчетов: магазины x дни
+    daily = grouped_sum(arrays.store, day, days, stores, arrays.sales)
+    reported = grouped_sum(arrays.store, day, days, stores) > 0
+
+    week = daily[:, -7:].sum(axis=1)
+    previous_week = daily[:, -14:-7].sum(axis=1)
+    average = rolling_average(daily, rolling_days)[:, -1]
+
+    # Последняя смена каждого магазина и та же смена неделю назад
+    by_shift = grouped_sum(arrays.store, day * shifts + arrays.shift, days * shifts, stores, arrays.sales)
+    last = np.flatnonzero(np.r_[arrays.store[1:] != arrays.store[:-1], True])
+    last_cell = day[last] * shifts + arrays.shift[last]
+    shift_sales = by_shift[arrays.store[last], last_cell]
+    week_ago = last_cell - 7 * shifts
+    last_week_shift_sales = np.where(week_ago >= 0, by_shift[arrays.store[last], np.maximum(week_ago, 0)], 0)
+
+    trends = [StoreTrend(str(arrays.stores[store]), int(week[store]), int(previous_week[store]),
+                         int(shift_value), int(week_ago_value), float(average[store]))
+              for store, shift_value, week_ago_value in zip(arrays.store[last], shift_sales, last_week_shift_sales)
+              ]
+
+    # Дни с необычными продажами относительно обычных для магазина
+    z = robust_z(np.where(reported, daily, np.nan))
+    median = np.nanmedian(np.where(reported, daily, np.nan), axis=1)
+    store_index, day_index = np.nonzero(reported & (np.abs(z) > z_limit))
+    latest = np.argsort(day_index, kind="stable")[-max_outliers:]
+    outliers = [Outlier(str(arrays.stores[store]), first_day + np.timedelta64(int(day_value), "D"),
+                        "продажи", int(daily[store, day_value]), float(median[store]))
+                for store, day_value in zip(store_index[latest], day_index[latest])
+                ]
+
+    # Остатки, не уменьшившиеся на сумму продаж с предыдущего отчета магазина
+    same_store = arrays.store[1:] == arrays.store[:-1]
+    expected = arrays.remainings[:-1] - arrays.sales[1:]
+    deviation = arrays.remainings[1:] - expected
+    limit = np.maximum(tolerance * arrays.sales[1:], min_delta)
+    index = np.flatnonzero(same_store & (np.abs(deviation) > limit)) + 1
+    outliers += [Outlier(str(arrays.stores[arrays.store[report]]), arrays.date[report], "остатки",
+                         int(arrays.remainings[report]), float(expected[report - 1]))
+                 for report in index[-max_outliers:]
+                 ]
+
+    outliers.sort(key=lambda outlier: outlier.date)
+    return Analysis(trends, outliers[-max_outliers:])
@@ -0,0 +1,241 @@
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+
+from aiohttp import web
+from config_reader import config
+from database import dispose_engine, read_session
+from datetime import date, datetime, timedelta
+from db_store import window_totals
+from response_cache import ResponseCache
+from sqlalchemy import select
+from time_range import WINDOW_CLOSE_DELAY, TimeRange
+
+
+#
+# JSON API и панель с суммами по сменам (в веб-процессе, см. web.py)
+#
+# GET /api/windows/current              - суммы текущей смены по магазинам
+# GET /api/windows/{bucket}             - суммы смены по номеру, например 2025061101
+# GET /api/windows?start=ДАТА&end=ДАТА  - суммы всех смен за дни [start, end]
+# GET /api/stores/{store}?start=&end=   - суммы магазина по сменам за дни
+# GET /dashboard                        - панель (static/dashboard.html)
+#
+# Суммы читаются из накопительной таблицы window_totals (есть и для архивных
+# смен). Готовые ответы (JSON, его gzip и ETag) хранятся в ResponseCache:
+# закрытые смены - пока не будут вытеснены, с текущей - CURRENT_TTL секунд.
+# Смена считается закрытой через WINDOW_CLOSE_DELAY после окончания:
+# до этого ее суммы еще пополняются отчетами из очереди пакетной записи.
+# Клиент, приславший тот же ETag в If-None-Match, получает 304 без тела.
+# Если задан API_TOKEN, запросы к API должны передавать его
+# в заголовке "Authorization: Bearer ..." или параметре token.
+#
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд ответ с текущей сменой считается свежим
+CURRENT_TTL = 10
+# Наибольший период запроса, дней
+MAX_RANGE_DAYS = 366
+# Ответы меньше этого размера не сжимаем
+GZIP_MIN_BYTES = 512
+
+DASHBOARD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "dashboard.html")
+
+api_cache = ResponseCache("api", max_bytes=config.api_cache_bytes)
+
+
+# Готовый ответ: тело, сжатое тело, ETag и время, до которого он свеж (None - всегда)
+def make_entry(data, expires=None):
+    body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    gzipped = gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None
+    return body, gzipped, etag, expires
+
+
+# Клиенту уже известен этот ответ
+def not_modified(request, etag):
+    header = request.headers.get("If-None-Match")
+    if header is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def respond(request, entry):
+
+    body, gzipped, etag, expires = entry
+    max_age = max(0, int(expires - time.monotonic())) if expires is not None else 3600
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={max_age}", "Vary": "Accept-Encoding"}
+
+    if not_modified(request, etag):
+        return web.Response(status=304, headers=headers)
+
+    if gzipped is not None and "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        body = gzipped
+
+    return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+
+
+# Ответ из кэша или построенный load() и сохраненный в кэш.
+# load возвращает данные и признак, что в них есть еще не закрытая смена
+async def cached_response(request, key, load):
+
+    entry = api_cache.get(key)
+    if entry is None or (entry[3] is not None and entry[3] < time.monotonic()):
+        data, current = await load()
+        entry = make_entry(data, time.monotonic() + CURRENT_TTL if current else None)
+        api_cache.put(key, entry)
+
+    return respond(request, entry)
+
+
+# Суммы смен по магазинам за [start, end) (при store - только этого магазина)
+async def window_rows(db, start, end, store=None):
+
+    query = (select(window_totals.c.window_start,
+                    window_totals.c.store,
+                    window_totals.c.sales,
+                    window_totals.c.remainings,
+                    window_totals.c.reports
+                    )
+             .where(window_totals.c.window_start >= start, window_totals.c.window_start < end)
+             .order_by(window_totals.c.window_start, window_totals.c.store)
+             )
+    if store is not None:
+        query = query.where(window_totals.c.store == store)
+
+    return (await db.execute(query)).all()
+
+
+# Смена и суммы ее магазинов в JSON
+def window_json(time_range, rows):
+    return dict(bucket=time_range.bucket,
+                start=time_range.start.isoformat(),
+                end=time_range.end.isoformat(timespec="seconds"),
+                range=time_range.range,
+                stores=[dict(store=row.store or None, sales=row.sales, remainings=row.remainings, reports=row.reports)
+                        for row in rows
+                        ],
+                sales=sum(row.sales for row in rows),
+                remainings=sum(row.remainings for row in rows),
+                reports=sum(row.reports for row in rows),
+                )
+
+
+# Смены за период с суммами, в порядке времени
+def windows_json(rows):
+    windows = {}
+    for row in rows:
+        windows.setdefault(row.window_start, []).append(row)
+    return [window_json(TimeRange.calculate_range(start), window) for start, window in windows.items()]
+
+
+# Смены, которые заканчиваются в end, еще могут измениться
+def still_open(end):
+    return end + WINDOW_CLOSE_DELAY >= datetime.now()
+
+
+# Суммы одной смены
+async def load_window(time_range):
+    async with read_session() as db:
+        rows = await window_rows(db, time_range.start, time_range.end)
+    return window_json(time_range, rows), still_open(time_range.end)
+
+
+# Период [start, end] из параметров запроса, по умолчанию - последние 7 дней
+def request_period(request):
+
+    try:
+        end = date.fromisoformat(request.query["end"]) if "end" in request.query else date.today()
+        start = date.fromisoformat(request.query["start"]) if "start" in request.query else end - timedelta(days=6)
+    except ValueError:
+        raise web.HTTPBadRequest(text="start и end - даты в формате ГГГГ-ММ-ДД")
+
+    if start > end or (end - start).days >= MAX_RANGE_DAYS:
+        raise web.HTTPBadRequest(text=f"Период - от 1 до {MAX_RANGE_DAYS} дней, start не позже end")
+
+    return datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.min.time()) + timedelta(days=1)
+
+
+async def current_window(request):
+    time_range = TimeRange.calculate_range(datetime.now())
+    return await cached_response(request, ("window", time_range.bucket), lambda: load_window(time_range))
+
+
+async def window_by_bucket(request):
+
+    try:
+        time_range = TimeRange.from_bucket(int(request.match_info["bucket"]))
+    except (ValueError, IndexError):
+        raise web.HTTPNotFound(text="Нет такой смены")
+
+    return await cached_response(request, ("window", time_range.bucket), lambda: load_window(time_range))
+
+
+async def windows_in_period(request):
+
+    start, end = request_period(request)
+
+    async def load():
+        async with read_session() as db:
+            rows = await window_rows(db, start, end)
+        return dict(start=start.date().isoformat(), windows=windows_json(rows)), still_open(end)
+
+    return await cached_response(request, ("windows", start, end), load)
+
+
+async def store_windows(request):
+
+    store = request.match_info["store"]
+    start, end = request_period(request)
+
+    async def load():
+        async with read_session() as db:
+            rows = await window_rows(db, start, end, store)
+        return dict(store=store, windows=windows_json(rows)), still_open(end)
+
+    return await cached_response(request, ("store", store, start, end), load)
+
+
+async def dashboard(request):
+    return web.FileResponse(DASHBOARD_PATH, headers={"Cache-Control": "no-cache"})
+
+
+# Проверяем токен API, если он задан
+def token_middleware(token):
+
+    @web.middleware
+    async def check_token(request, handler):
+        if token is not None and request.path.startswith("/api/"):
+            supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip() or request.query.get("token")
+            # Сравнение за постоянное время не выдает по задержке ответа совпавшее начало токена
+            if not supplied or not hmac.compare_digest(supplied.encode(), token.encode()):
+                raise web.HTTPUnauthorized(text="Нужен токен API")
+        return await handler(request)
+
+    return check_token
+
+
+# Подключаем API и панель к приложению веб-процесса
+def setup_api(app, token=None):
+
+    if token is None:
+        logger.warning("API_TOKEN не задан: суммы по сменам доступны без токена")
+
+    app.middlewares.append(token_middleware(token))
+    app.router.add_get("/api/windows/current", current_window)
+    app.router.add_get("/api/windows/{bucket:\\d+}", window_by_bucket)
+    app.router.add_get("/api/windows", windows_in_period)
+    app.router.add_get("/api/stores/{store}", store_windows)
+    app.router.add_get("/dashboard", dashboard)
+
+    async def close_database(app):
+        await dispose_engine()
+
+    app.on_cleanup.append(close_database)
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import sys
+
+from collections import defaultdict
+from database import archive_database_address, dispose_engine, get_async_engine
+from datetime import datetime, timedelta
+from db_store import Reports, archive_runs, report_revisions, window_totals
+from sqlalchemy import Column, Index, MetaData, Table, delete, func, insert, select, update
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.engine import make_url
+from time_range import TimeRange
+from window_totals import accumulate, totals_rows
+
+
+#
+# Архивация старых отчетов
+#
+# Отчеты старше ARCHIVE_AFTER_DAYS дней (по границе смены) переносятся
+# в отдельную БД SQLite, а в основной остаются только суммы по сменам
+# и магазинам (window_totals), пересчитанные в транзакции переноса.
+# Сводки по старым сменам строятся по суммам, список отчетов читается
+# из архива (см. results.py). После переноса освободившееся место
+# возвращается постепенно (incremental_vacuum), статистика обновляется
+# через PRAGMA optimize.
+#
+# Запуск: python archive.py [дней], например по расписанию раз в сутки.
+#
+
+logger = logging.getLogger(__name__)
+
+# Отчетов за одну транзакцию переноса
+CHUNK_ROWS = 5000
+# Сколько строк ANALYZE читает из каждого индекса
+ANALYSIS_LIMIT = 1000
+
+# Имя архивной БД в подключении основной
+ARCHIVE_SCHEMA = "archive"
+
+reports = Reports.__table__
+
+archive_metadata = MetaData()
+
+
+# Таблица архива с теми же столбцами. Без первичного ключа: номера
+# строк основной БД после удаления могут выдаваться повторно
+def archive_table(table):
+    return Table(table.name, archive_metadata,
+                 *[Column(column.name, column.type) for column in table.columns],
+                 schema=ARCHIVE_SCHEMA
+                 )
+
+
+archive_reports = archive_table(reports)
+archive_revisions = archive_table(report_revisions)
+
+Index('ix_reports_bucket', archive_reports.c.bucket, archive_reports.c.reports_id)
+Index('ix_reports_date', archive_reports.c.date)
+Index('ix_report_revisions_reports_id', archive_revisions.c.reports_id)
+
+
+# Граница архивации: начало смены, в которую попадает момент days дней назад
+def archive_cutoff(days, now=None):
+    return TimeRange.calculate_range((now or datetime.now()) - timedelta(days=days)).start
+
+
+# Граница последней архивации (None, если ее не было)
+async def archived_before(db):
+    return await db.scalar(select(func.max(archive_runs.c.archived_before)))
+
+
+# Пересчитываем суммы смен, отчеты которых (с датой раньше before) будут перенесены
+def rollup(conn, before, chunk_size=CHUNK_ROWS):
+
+    totals = defaultdict(lambda: [0, 0, 0])
+    result = conn.execute(select(reports.c.date, reports.c.store, reports.c.sales, reports.c.remainings)
+                          .where(reports.c.date < before)
+                          .execution_options(yield_per=chunk_size)
+                          )
+    for rows in result.partitions():
+        accumulate(totals, rows)
+
+    if totals:
+        query = sqlite.insert(window_totals)
+        query = query.on_conflict_do_update(index_elements=[window_totals.c.window_start, window_totals.c.store],
+                                            set_=dict(sales=query.excluded.sales,
+                                                      remainings=query.excluded.remainings,
+                                                      reports=query.excluded.reports,
+                                                      ))
+        conn.execute(query, totals_rows(totals))
+
+    return len(totals)
+
+
+# Конец очередной части переноса: части состоят из целых смен
+# (не меньше одной), около chunk_size отчетов
+def chunk_end(conn, cutoff, chunk_size=CHUNK_ROWS):
+
+    dates = conn.execute(select(reports.c.date)
+                         .where(reports.c.date < cutoff)
+                         .order_by(reports.c.date)
+                         .limit(chunk_size)
+                         ).scalars().all()
+    if not dates:
+        return None
+    if len(dates) < chunk_size:
+        return cutoff
+
+    # Смена последнего отчета может продолжаться за частью: она уйдет в следующую
+    last = TimeRange.calculate_range(dates[-1])
+    if last.start > dates[0]:
+        return last.start
+
+    return min(last.end + timedelta(microseconds=1), cutoff)
+
+
+# Переносим отчеты до границы и их правки в подключенный архив.
+# Каждая транзакция переносит целые смены вместе с пересчетом их сумм
+# и продвигает границу запуска в archive_runs, поэтому прерванный запуск
+# не оставляет смен, часть отчетов которых уже в архиве
+def move_reports(conn, cutoff, chunk_size=CHUNK_ROWS):
+
+    moved = 0
+    run_id = None
+    while True:
+        end = chunk_end(conn, cutoff, chunk_size)
+        if end is None:
+            break
+
+        rollup(conn, end, chunk_size)
+
+        ids = select(reports.c.reports_id).where(reports.c.date < end)
+        conn.execute(insert(archive_reports).from_select([column.name for column in reports.columns],
+                                                         select(*reports.columns).where(reports.c.date < end)
+                                                         ))
+        revisions = select(*report_revisions.columns).where(report_revisions.c.reports_id.in_(ids))
+        conn.execute(insert(archive_revisions).from_select([column.name for column in report_revisions.columns],
+                                                           revisions
+                                                           ))
+        conn.execute(delete(report_revisions).where(report_revisions.c.reports_id.in_(ids)))
+        count = conn.execute(delete(reports).where(reports.c.date < end)).rowcount
+
+        run = dict(archived_before=end, rows=moved + count, finished=datetime.now())
+        if run_id is None:
+            run_id = conn.execute(insert(archive_runs).values(**run)).inserted_primary_key[0]
+        else:
+            conn.execute(update(archive_runs).where(archive_runs.c.run_id == run_id).values(**run))
+        conn.commit()
+
+        moved += count
+        logger.info("Перенесено в архив отчетов: %d", moved)
+
+    return moved
+
+
+# Архивация на синхронном соединении основной БД
+def archive(conn, cutoff, path, chunk_size=CHUNK_ROWS):
+
+    # ATTACH выполняется вне транзакции
+    conn.exec_driver_sql("ATTACH DATABASE ? AS " + ARCHIVE_SCHEMA, (path,))
+    try:
+        archive_metadata.create_all(conn)
+        conn.commit()
+
+        moved = move_reports(conn, cutoff, chunk_size)
+        conn.exec_driver_sql(f"PRAGMA {ARCHIVE_SCHEMA}.optimize")
+    finally:
+        conn.rollback()
+        conn.exec_driver_sql("DETACH DATABASE " + ARCHIVE_SCHEMA)
+
+    return moved
+
+
+# Возвращаем место, освободившееся после удаления отчетов, и обновляем статистику.
+# Первый раз БД переводится в режим incremental (полный VACUUM), дальше
+# освобождаются только пустые страницы, без перестройки файла
+def compact(conn, pages=0):
+
+    if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+        logger.info("Включаем auto_vacuum=INCREMENTAL (полный VACUUM)")
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+    else:
+        # Прагма не возвращает столбцов, поэтому драйвер выполняет ее до конца
+        conn.exec_driver_sql(f"PRAGMA incremental_vacuum({pages})" if pages else "PRAGMA incremental_vacuum")
+
+    conn.exec_driver_sql(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+    conn.exec_driver_sql("PRAGMA optimize")
+    conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+# Архивируем отчеты старше days дней и уплотняем основную БД
+async def run_archive(days, engine=None, path=None, now=None):
+
+    engine = engine or get_async_engine()
+    if engine.dialect.name != "sqlite":
+        raise RuntimeError("Архивация в отдельный файл поддерживается только для SQLite")
+
+    path = path or make_url(archive_database_address()).database
+    cutoff = archive_cutoff(days, now)
+
+    async with engine.connect() as conn:
+        moved = await conn.run_sync(archive, cutoff, path)
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.run_sync(compact)
+
+    return cutoff, moved
+
+
+# Архивация из командной строки: python archive.py [дней]
+async def main():
+
+    from config_reader import config
+    from migrations import migrate_database
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else config.archive_after_days
+
+    try:
+        await migrate_database()
+        started = datetime.now()
+        cutoff, moved = await run_archive(days)
+        path = make_url(get_async_engine().url).database
+        print(f"Перенесено отчетов до {cutoff:%d.%m.%Y %H:%M}: {moved} "
+              f"за {(datetime.now() - started).total_seconds():.2f} с, "
+              f"размер БД {os.path.getsize(path) / 1024 / 1024:.2f} МБ")
+    finally:
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+import csv
+
+from typing import NamedTuple
+
+
+#
+# Отчеты по нескольким магазинам одним сообщением
+#
+# Каждая строка сообщения или CSV-файла - "магазин;остатки;продажи".
+# Строки разбираются и проверяются за один проход, ошибки собираются
+# по номерам строк, а правильные строки записываются одной транзакцией
+# (см. sales.py, ReportWriter.submit_many).
+#
+
+# Наибольшее количество строк в одном сообщении или файле
+MAX_LINES = 500
+# Наибольшая длина названия магазина
+MAX_STORE_LENGTH = 100
+# Наибольший размер CSV-файла, байт
+MAX_DOCUMENT_BYTES = 256 * 1024
+# Сколько ошибок показываем в ответе
+MAX_ERRORS_SHOWN = 20
+
+# Первая строка с такими названиями столбцов - заголовок
+HEADER_NAMES = {"магазин", "store"}
+
+
+class BulkLine(NamedTuple):
+    line: int
+    store: str
+    remainings: int
+    sales: int
+
+
+class BulkError(NamedTuple):
+    line: int
+    error: str
+
+
+# Текст CSV-файла: UTF-8 (с BOM или без) или Windows-1251 (выгрузка из Excel).
+# None - файл не текстовый (например, .xlsx, отправленный по ошибке)
+def decode_document(data):
+    if b"\0" in data:
+        return None
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return None
+
+
+# Разбираем строки "магазин;остатки;продажи", возвращаем правильные строки и ошибки
+def parse_bulk(text):
+
+    lines = []
+    errors = []
+    # Магазин -> строка, в которой он указан впервые
+    stores = {}
+
+    rows = [(number, row) for number, row in enumerate(csv.reader(text.splitlines(), delimiter=";"), 1)
+            if any(field.strip() for field in row)
+            ]
+
+    if rows and rows[0][1][0].strip().lower() in HEADER_NAMES:
+        rows = rows[1:]
+
+    if len(rows) > MAX_LINES:
+        return [], [BulkError(rows[MAX_LINES][0], f"строк больше {MAX_LINES}, разделите отчёт на части")]
+
+    for number, row in rows:
+        fields = [field.strip() for field in row]
+
+        if len(fields) != 3:
+            errors.append(BulkError(number, "ожидается: магазин;остатки;продажи"))
+            continue
+
+        store, remainings, sales = fields
+
+        if not store:
+            errors.append(BulkError(number, "не указан магазин"))
+        elif len(store) > MAX_STORE_LENGTH:
+            errors.append(BulkError(number, f"название магазина длиннее {MAX_STORE_LENGTH} символов"))
+        elif not remainings.isdigit():
+            errors.append(BulkError(number, "остатки - не число"))
+        elif not sales.isdigit():
+            errors.append(BulkError(number, "продажи - не число"))
+        elif store in stores:
+            errors.append(BulkError(number, f"магазин уже указан в строке {stores[store]}"))
+        else:
+            stores[store] = number
+            lines.append(BulkLine(number, store, int(remainings), int(sales)))
+
+    return lines, errors
+
+
+# Текст ответа: сколько отчетов принято и ошибки по строкам
+def bulk_summary(lines, errors):
+
+    result = [f"Принято отчётов: {len(lines)}"]
+    if lines:
+        result.append(f"Остатки: {sum(line.remainings for line in lines)}, "
+                      f"продажи: {sum(line.sales for line in lines)}")
+
+    if errors:
+        result.append("➖➖➖➖➖➖")
+        result.append(f"Ошибки ({len(errors)}):")
+        result += [f"строка {error.line}: {error.error}" for error in errors[:MAX_ERRORS_SHOWN]]
+        if len(errors) > MAX_ERRORS_SHOWN:
+            result.append(f"... и ещё {len(errors) - MAX_ERRORS_SHOWN}")
+
+    return "\n".join(result)
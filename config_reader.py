@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import SecretStr
+from pydantic import SecretStr, field_validator
+from typing import List, Literal, Optional
 
 
 class Settings(BaseSettings):
@@ -11,6 +12,69 @@ class Settings(BaseSettings):
     database_address: SecretStr
     admin_id: SecretStr
 
+    # Размер и время жизни (в секундах) кэша пользователей
+    user_cache_size: int = 10000
+    user_cache_ttl: int = 300
+
+    # Объем памяти (в байтах) под кэш отчетов за прошедшие диапазоны
+    window_cache_bytes: int = 4 * 1024 * 1024
+
+    # График смен: часы начала смен, например SHIFT_HOURS=[0,12,18]
+    shift_hours: List[int] = [0, 12, 18]
+
+    # Рассылка итогов по окончании каждой смены: администратору
+    # и дополнительным чатам, например DIGEST_CHAT_IDS=[123,456]
+    shift_digest: bool = True
+    digest_chat_ids: List[int] = []
+
+    # Сохранять прежние значения отчетов, исправленных в ту же смену
+    report_revisions: bool = True
+
+    # Отчеты старше archive_after_days дней переносятся в архивную БД
+    # (python archive.py), по умолчанию - файл рядом с основной БД
+    archive_after_days: int = 90
+    archive_database_address: Optional[SecretStr] = None
+
+    # Одинаковые нажатия пользователя чаще, чем раз в throttle_interval
+    # секунд, обрабатываются один раз
+    throttle_interval: float = 1.0
+
+    # Состояния FSM: период записи в БД (с), выгрузка неактивных чатов
+    # из памяти и удаление из БД (с)
+    fsm_flush_interval: float = 1.0
+    fsm_memory_ttl: int = 600
+    fsm_ttl: int = 30 * 24 * 3600
+
+    # JSON API веб-процесса (см. api.py): токен доступа и объем памяти
+    # (в байтах) под кэш готовых ответов
+    api_token: Optional[SecretStr] = None
+    api_cache_bytes: int = 4 * 1024 * 1024
+
+    # Период записи снимка метрик процесса ботов в БД для /metrics, с
+    metrics_flush_interval: float = 15.0
+
+    # Количество процессов обработки апдейтов каждого бота (см. sharding.py)
+    workers: int = 1
+
+    # Режим журнала SQLite: WAL позволяет читать во время записи
+    sqlite_journal_mode: str = "wal"
+
+    # Способ получения апдейтов: поллинг в каждом боте или вебхуки в web.py
+    bot_mode: Literal["polling", "webhook"] = "polling"
+    # Внешний адрес веб-процесса, например https://example.herokuapp.com
+    webhook_base_url: Optional[str] = None
+    # Секрет, который Telegram передает в заголовке каждого запроса вебхука
+    webhook_secret: Optional[SecretStr] = None
+    # Порт веб-процесса (Heroku передает его в переменной PORT)
+    port: int = 8080
+
+    @field_validator("shift_hours")
+    @classmethod
+    def check_shift_hours(cls, hours):
+        if not hours or hours[0] != 0 or hours != sorted(set(hours)) or hours[-1] > 23:
+            raise ValueError("SHIFT_HOURS: часы по возрастанию от 0 до 23, первая смена с 0")
+        return hours
+
     # Начиная со второй версии pydantic, настройки класса настроек задаются
     # через model_config
     # В данном случае будет использоваться файла .env, который будет прочитан
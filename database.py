@@ -0,0 +1,174 @@
+import os
+
+from metrics import track_queries
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from storage import storage_for
+
+
+#
+# Асинхронный слой подключения к БД
+# (различия SQLite и PostgreSQL - в storage.py)
+#
+
+# Асинхронные драйверы для адресов БД из конфига
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+# Размер пула соединений движка
+POOL_SIZE = 5
+# Дополнительные соединения сверх пула при пиковой нагрузке
+POOL_MAX_OVERFLOW = 10
+
+# Переводим адрес БД (sqlite:///...) на асинхронный драйвер
+def async_database_address(address):
+    url = make_url(address)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+
+    if driver is not None and url.drivername != driver:
+        url = url.set(drivername=driver)
+
+    return url
+
+
+# Создаем асинхронный движок с пулом соединений
+def create_async_db_engine(address, pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW, 
+                           journal_mode=None, read_only=False, **kwargs):
+    url = async_database_address(address)
+    storage = storage_for(url.get_backend_name())
+
+    # БД в памяти живет в одном соединении, пул для нее не настраивается
+    if storage.dialect != "sqlite" or url.database not in (None, "", ":memory:"):
+        kwargs.setdefault("pool_size", pool_size)
+        kwargs.setdefault("max_overflow", max_overflow)
+        kwargs.setdefault("pool_pre_ping", True)
+
+    kwargs.setdefault("connect_args", storage.connect_args(read_only=read_only))
+    engine = create_async_engine(url, echo=False, **kwargs)
+    storage.configure(engine, journal_mode=journal_mode, read_only=read_only)
+
+    # Время запросов для /metrics
+    track_queries(engine)
+
+    return engine
+
+
+# Фабрика асинхронных сессий для обработчиков
+def create_session_factory(engine):
+    return async_sessionmaker(engine,
+                              class_=AsyncSession,
+                              autoflush=False,
+                              expire_on_commit=False
+                              )
+
+
+#
+# Общие движки процесса, создаются при первом обращении:
+# основной (чтение и запись) и отдельный пул только для чтения
+#
+
+_engine = None
+_session_factory = None
+_read_engine = None
+_read_session_factory = None
+_archive_engine = None
+_archive_session_factory = None
+
+
+def get_async_engine():
+    global _engine, _session_factory
+
+    if _engine is None:
+        from config_reader import config
+        _engine = create_async_db_engine(config.database_address.get_secret_value(),
+                                         journal_mode=config.sqlite_journal_mode
+                                         )
+        _session_factory = create_session_factory(_engine)
+
+    return _engine
+
+
+def get_read_engine():
+    global _read_engine, _read_session_factory
+
+    if _read_engine is None:
+        from config_reader import config
+        _read_engine = create_async_db_engine(config.database_address.get_secret_value(), read_only=True)
+        _read_session_factory = create_session_factory(_read_engine)
+
+    return _read_engine
+
+
+# Адрес архивной БД (см. archive.py): из настроек или рядом с основной,
+# например reports.db -> reports_archive.db
+def archive_database_address():
+    from config_reader import config
+
+    if config.archive_database_address is not None:
+        return config.archive_database_address.get_secret_value()
+
+    url = make_url(config.database_address.get_secret_value())
+    root, extension = os.path.splitext(url.database or "")
+    return url.set(database=f"{root}_archive{extension or '.db'}").render_as_string(hide_password=False)
+
+
+# Движок архивной БД только для чтения (подробности по старым диапазонам)
+def get_archive_engine():
+    global _archive_engine, _archive_session_factory
+
+    if _archive_engine is None:
+        _archive_engine = create_async_db_engine(archive_database_address(), read_only=True)
+        _archive_session_factory = create_session_factory(_archive_engine)
+
+    return _archive_engine
+
+
+# Новая сессия общего движка: async with async_session() as db
+def async_session():
+    get_async_engine()
+    return _session_factory()
+
+
+# Новая сессия только для чтения (сводки не ждут пишущие транзакции)
+def read_session():
+    get_read_engine()
+    return _read_session_factory()
+
+
+# Новая сессия архивной БД
+def archive_session():
+    get_archive_engine()
+    return _archive_session_factory()
+
+
+# Закрываем соединения общих движков (при остановке бота)
+async def dispose_engine():
+    global _engine, _session_factory, _read_engine, _read_session_factory
+    global _archive_engine, _archive_session_factory
+
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+        _session_factory = None
+
+    if _read_engine is not None:
+        await _read_engine.dispose()
+        _read_engine = None
+        _read_session_factory = None
+
+    if _archive_engine is not None:
+        await _archive_engine.dispose()
+        _archive_engine = None
+        _archive_session_factory = None
+
+
+# Хранилище диалекта сессии (см. storage.py)
+def session_storage(db):
+    return storage_for(db.get_bind().dialect.name)
+
+
+# INSERT с поддержкой ON CONFLICT для диалекта текущей сессии
+def dialect_insert(db, table):
+    return session_storage(db).insert(table)
@@ -1,28 +1,29 @@
-
-from config_reader import config
-from datetime import datetime, timedelta
-from sqlalchemy import  Integer, Text, ForeignKey
-from sqlalchemy import create_engine
-from sqlalchemy.orm import DeclarativeBase, Mapped, Session
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Index, Integer, Table, Text, func, literal_column
+from sqlalchemy.orm import DeclarativeBase, Mapped
 from sqlalchemy.orm import mapped_column, relationship
 from typing import List, Optional
 
 
-
-# Адрес БД
-sqlite_database = config.database_address.get_secret_value()
-# Cоздаем движок SqlAlchemy
-engine = create_engine(sqlite_database, echo=False)
-
+#
+# Модель БД (общая для обоих ботов)
+#
+# Таблицы создаются и обновляются миграциями (migrations.py) при старте бота,
+# а не при импорте модуля.
+#
 
 class Base(DeclarativeBase):
     pass
 
 
+# Идентификаторы Telegram не помещаются в 32 бита: в PostgreSQL - BIGINT,
+# в SQLite остается INTEGER (целые там и так 64-битные)
+TelegramId = BigInteger().with_variant(Integer, "sqlite")
+
+
 class Users(Base):
     __tablename__ = 'users'
 
-    tg_id: Mapped[Optional[int]] = mapped_column(Integer, primary_key=True)
+    tg_id: Mapped[Optional[int]] = mapped_column(TelegramId, primary_key=True, autoincrement=False)
     name: Mapped[Optional[int]] = mapped_column(Text)
     store: Mapped[Optional[int]] = mapped_column(Text)
 
@@ -33,34 +34,95 @@ class Reports(Base):
     __tablename__ = 'reports'
 
     reports_id: Mapped[Optional[int]] = mapped_column(Integer, primary_key=True)
-    sales: Mapped[Optional[str]] = mapped_column(Integer)
-    remainings: Mapped[Optional[str]] = mapped_column(Integer)
-    user: Mapped[Optional[int]] = mapped_column(ForeignKey('users.tg_id'))
+    sales: Mapped[Optional[int]] = mapped_column(Integer)
+    remainings: Mapped[Optional[int]] = mapped_column(Integer)
+    user: Mapped[Optional[int]] = mapped_column(TelegramId, ForeignKey('users.tg_id'))
+    # Имя пользователя Telegram (в старых БД SQLite столбец объявлен как INTEGER)
+    username: Mapped[Optional[str]] = mapped_column(Text)
+    store: Mapped[Optional[str]] = mapped_column(Text)
+    date: Mapped[Optional[str]] = mapped_column(DateTime)
+    # Номер временного диапазона (TimeRange.bucket), задается при записи
+    bucket: Mapped[Optional[int]] = mapped_column(Integer)
 
     users: Mapped[Optional['Users']] = relationship('Users', back_populates='reports')
 
-
-# Добавляем пользователя в БД если отуствует
-def add_user(tg_id, name="", store=""):
-
-    # Создаем объект пользователя
-    user = Users(tg_id=tg_id, name=name, store=store)
-
-    # Проверяем наличие записи пользователя в БД
-    query = db.query(Users).filter(Users.tg_id==tg_id).first()
-    
-    if query is None:        
-        # Добавляем пользователя в БД
-        db.add(user)
-        db.commit()
-        db.refresh(user) 
-        print(f"Пользователь [{user.tg_id}] - {user.name} ({user.store}) добавлен в БД!") 
-
-    else: 
-        print(f"Пользователь [{user.tg_id}] - {user.name} ({user.store}) уже существует в БД!") 
-    
-    return user
-
-
-# Cоздаем таблицы
-Base.metadata.create_all(bind=engine)
+    # Индексы для выборок по временному диапазону
+    __table_args__ = (
+        Index('ix_reports_date', 'date'),
+        Index('ix_reports_store_date', 'store', 'date'),
+        Index('ix_reports_bucket', 'bucket'),
+    )
+
+
+# Ключ отчета: пользователь, магазин (пустая строка вместо NULL) и смена.
+# Повторная передача данных за смену обновляет ту же строку (см. submissions.py)
+SUBMISSION_KEY = (Reports.__table__.c.user,
+                  func.coalesce(Reports.__table__.c.store, literal_column("''")),
+                  Reports.__table__.c.bucket,
+                  )
+Index('ux_reports_submission', *SUBMISSION_KEY, unique=True)
+
+
+# Прежние значения перезаписанных отчетов
+report_revisions = Table(
+    'report_revisions', Base.metadata,
+    Column('revision_id', Integer, primary_key=True),
+    Column('reports_id', Integer, nullable=False, index=True),
+    Column('sales', Integer),
+    Column('remainings', Integer),
+    Column('date', DateTime),
+)
+
+
+# Накопительные суммы по временным диапазонам (см. window_totals.py)
+window_totals = Table(
+    'window_totals', Base.metadata,
+    Column('window_start', DateTime, primary_key=True),
+    # Пустая строка вместо NULL, чтобы магазин участвовал в первичном ключе
+    Column('store', Text, primary_key=True, default=''),
+    Column('sales', Integer, nullable=False, default=0),
+    Column('remainings', Integer, nullable=False, default=0),
+    Column('reports', Integer, nullable=False, default=0),
+)
+
+
+# Состояния FSM чатов обоих ботов (см. fsm_storage.py)
+fsm_states = Table(
+    'fsm_states', Base.metadata,
+    # Ключ чата: бот, чат, пользователь и т. д.
+    Column('key', Text, primary_key=True),
+    Column('state', Text),
+    # Данные FSM в JSON
+    Column('data', Text, nullable=False, default='{}'),
+    Column('updated', DateTime, nullable=False, index=True),
+)
+
+
+# Запуски архивации отчетов (см. archive.py): отчеты с датой раньше
+# archived_before перенесены в архивную БД
+archive_runs = Table(
+    'archive_runs', Base.metadata,
+    Column('run_id', Integer, primary_key=True),
+    Column('archived_before', DateTime, nullable=False),
+    Column('rows', Integer, nullable=False),
+    Column('finished', DateTime, nullable=False),
+)
+
+
+# Снимки метрик процессов ботов (см. metrics_store.py)
+metrics_snapshots = Table(
+    'metrics_snapshots', Base.metadata,
+    # Хост и номер процесса
+    Column('process', Text, primary_key=True),
+    Column('updated', DateTime, nullable=False),
+    # Метрики процесса в JSON (metrics.snapshot)
+    Column('data', Text, nullable=False),
+)
+
+
+# Версии примененных миграций схемы
+schema_version = Table(
+    'schema_version', Base.metadata,
+    Column('version', Integer, primary_key=True),
+    Column('applied', DateTime, nullable=False),
+)
@@ -0,0 +1,99 @@
+import asyncio
+import csv
+
+from db_store import Reports
+from sqlalchemy import select
+
+
+#
+# Выгрузка отчетов за период в CSV или XLSX
+#
+# Отчеты читаются из БД частями по CHUNK_ROWS строк (курсор на стороне
+# сервера), каждая часть дописывается в файл в отдельном потоке,
+# поэтому память не растет с размером выгрузки, а цикл событий не блокируется.
+#
+
+# Строк в одной части выгрузки
+CHUNK_ROWS = 1000
+
+EXPORT_FORMATS = ("csv", "xlsx")
+
+EXPORT_HEADER = ("Номер", "Дата", "Магазин", "Продажи", "Остатки", "Пользователь")
+
+
+# Отчеты за период [start, end) по возрастанию даты
+def export_query(start, end):
+    return (select(Reports.reports_id,
+                   Reports.date,
+                   Reports.store,
+                   Reports.sales,
+                   Reports.remainings,
+                   Reports.username
+                   )
+            .where(Reports.date >= start, Reports.date < end)
+            .order_by(Reports.date, Reports.reports_id)
+            )
+
+
+# Запись в CSV (с BOM, чтобы Excel распознал UTF-8)
+class CsvExport:
+
+    def __init__(self, path):
+        self.file = open(path, "w", newline="", encoding="utf-8-sig")
+        self.writer = csv.writer(self.file, delimiter=";")
+        self.writer.writerow(EXPORT_HEADER)
+
+    def write_rows(self, rows):
+        self.writer.writerows((*row[:1], row[1].strftime("%d.%m.%Y %H:%M:%S"), *row[2:]) for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+# Запись в XLSX: книга в режиме write_only не держит строки в памяти
+class XlsxExport:
+
+    def __init__(self, path):
+        from openpyxl import Workbook
+
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet("Отчёты")
+        self.sheet.append(EXPORT_HEADER)
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.sheet.append(tuple(row))
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+EXPORTERS = {
+    "csv": CsvExport,
+    "xlsx": XlsxExport,
+}
+
+
+# Выгружаем отчеты за период в файл, возвращаем количество строк.
+# archive - сессия архивной БД: ее отчеты старше, поэтому выгружаются первыми
+async def export_reports(db, start, end, path, format="csv", chunk_rows=CHUNK_ROWS, archive=None):
+
+    exporter = await asyncio.to_thread(EXPORTERS[format], path)
+    count = 0
+
+    try:
+        for source in (archive, db):
+            if source is None:
+                continue
+            result = await source.stream(export_query(start, end).execution_options(yield_per=chunk_rows))
+            try:
+                async for rows in result.partitions():
+                    await asyncio.to_thread(exporter.write_rows, rows)
+                    count += len(rows)
+            finally:
+                await result.close()
+    finally:
+        await asyncio.to_thread(exporter.close)
+
+    return count
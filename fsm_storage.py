@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from database import dialect_insert
+from datetime import datetime, timedelta
+from db_store import fsm_states
+from sqlalchemy import delete, select
+
+
+#
+# Хранилище состояний FSM в БД
+#
+# Состояния и данные чатов читаются из памяти, а в БД записываются
+# фоновой задачей раз в flush_interval секунд: несколько переходов
+# одного чата за это время превращаются в одну запись.
+# Чаты, не активные дольше memory_ttl, выгружаются из памяти,
+# а дольше ttl - удаляются и из БД.
+#
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseStorage(BaseStorage):
+
+    def __init__(self, session_factory, flush_interval=1.0, memory_ttl=600, ttl=30 * 24 * 3600,
+                 cleanup_interval=60, clock=time.monotonic):
+
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.memory_ttl = memory_ttl
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.clock = clock
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.flushes = 0
+        self.rows = 0
+        # Ключ чата -> [состояние, данные, время последнего обращения]
+        self._records = {}
+        self._dirty = set()
+        self._task = None
+        self._last_cleanup = clock()
+
+    # Запись чата из памяти, при отсутствии - из БД
+    async def _record(self, key):
+
+        name = self.key_builder.build(key)
+        record = self._records.get(name)
+
+        if record is None:
+            async with self.session_factory() as db:
+                row = (await db.execute(select(fsm_states.c.state, fsm_states.c.data)
+                                        .where(fsm_states.c.key == name)
+                                        )).first()
+            # Пока шел запрос, запись могла появиться
+            record = self._records.get(name)
+            if record is None:
+                record = [row.state, json.loads(row.data), 0] if row else [None, {}, 0]
+                self._records[name] = record
+
+        record[2] = self.clock()
+        return name, record
+
+    def _changed(self, name):
+        self._dirty.add(name)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def set_state(self, key, state = None):
+        name, record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._changed(name)
+
+    async def get_state(self, key):
+        _, record = await self._record(key)
+        return record[0]
+
+    async def set_data(self, key, data):
+        name, record = await self._record(key)
+        record[1] = data.copy()
+        self._changed(name)
+
+    async def get_data(self, key):
+        _, record = await self._record(key)
+        return record[1].copy()
+
+    # Записываем накопившиеся изменения одной транзакцией
+    async def flush(self):
+
+        if not self._dirty:
+            return
+
+        names, self._dirty = self._dirty, set()
+        now = datetime.now()
+        upserts = []
+        removed = []
+
+        for name in names:
+            state, data, _ = self._records[name]
+            # Чат без состояния и данных в БД не храним
+            if state is None and not data:
+                removed.append(name)
+            else:
+                upserts.append(dict(key=name, state=state, data=json.dumps(data, ensure_ascii=False), updated=now))
+
+        try:
+            async with self.session_factory() as db:
+                if upserts:
+                    query = dialect_insert(db, fsm_states)
+                    query = query.on_conflict_do_update(index_elements=[fsm_states.c.key],
+                                                        set_=dict(state=query.excluded.state,
+                                                                  data=query.excluded.data,
+                                                                  updated=query.excluded.updated,
+                                                                  ))
+                    await db.execute(query, upserts)
+                if removed:
+                    await db.execute(delete(fsm_states).where(fsm_states.c.key.in_(removed)))
+                await db.commit()
+        except BaseException:
+            # Не записанные изменения попробуем записать в следующий раз
+            self._dirty |= names
+            raise
+
+        self.flushes += 1
+        self.rows += len(names)
+
+    # Чаты передаются другому процессу (см. sharding.py): записываем изменения
+    # и забываем их, чтобы при возврате прочитать актуальные записи из БД.
+    # chats(chat_id) - принадлежит ли чат передаваемым
+    async def release(self, chats):
+
+        await self.flush()
+        for name in [name for name in self._records if chats(int(name.split(self.key_builder.separator)[2]))]:
+            del self._records[name]
+
+    # Выгружаем неактивные чаты из памяти и удаляем устаревшие из БД
+    async def cleanup(self):
+
+        idle = self.clock() - self.memory_ttl
+        for name in [name for name, record in self._records.items() if record[2] < idle and name not in self._dirty]:
+            del self._records[name]
+
+        async with self.session_factory() as db:
+            await db.execute(delete(fsm_states).where(fsm_states.c.updated < datetime.now() - timedelta(seconds=self.ttl)))
+            await db.commit()
+
+        self._last_cleanup = self.clock()
+
+    async def _run(self):
+        while self._dirty or self._records:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if self.clock() - self._last_cleanup >= self.cleanup_interval:
+                    await self.cleanup()
+            except Exception:
+                logger.exception("Не удалось записать состояния FSM")
+
+    # Останавливаем фоновую задачу и записываем оставшиеся изменения
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,36 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+
+#
+# Логирование через очередь
+#
+# Обработчики только кладут запись в очередь, а вывод в stdout выполняет
+# отдельный поток, поэтому медленный вывод не задерживает цикл событий.
+#
+
+_listener = None
+
+
+# Настраиваем корневой логгер (повторный вызов ничего не меняет)
+def setup_logging(level=logging.INFO):
+    global _listener
+
+    if _listener is not None:
+        return
+
+    records = queue.SimpleQueue()
+
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    # Дописываем оставшиеся записи при выходе
+    atexit.register(_listener.stop)
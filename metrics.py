@@ -0,0 +1,225 @@
+import json
+import os
+import socket
+import time
+
+from aiogram import BaseMiddleware
+from bisect import bisect_left
+from sqlalchemy import event
+
+
+#
+# Метрики процесса в текстовом формате Prometheus (отдаются на /metrics, см. web.py)
+#
+# Задержки обработчиков обоих ботов, время запросов к БД и количество
+# отчетов по временным диапазонам. Метрики хранятся в памяти процесса,
+# снимки метрик процессов ботов складываются на /metrics (см. metrics_store.py).
+#
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Все метрики процесса в порядке создания
+REGISTRY = []
+
+# Имя процесса в снимках метрик: хост (на Heroku - дайно) и номер процесса
+PROCESS = f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Экранируем значение метки
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# Метки в виде {name="value",...}
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Число в формате Prometheus
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    # Описание и значения метрики для снимка
+    def dump(self):
+        return dict(name=self.name, kind=self.kind, help=self.help, labels=self.labels,
+                    values=[[list(key), value] for key, value in self.values.items()])
+
+    # Добавляем значения из снимка другого процесса
+    def merge(self, values):
+        for key, value in values:
+            key = tuple(key)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Метки -> [количество по корзинам, сумма, общее количество]
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, **labels):
+
+        key = tuple(labels[name] for name in self.labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def dump(self):
+        return dict(name=self.name, kind=self.kind, help=self.help, labels=self.labels, buckets=self.buckets,
+                    values=[[list(key), series] for key, series in self.values.items()])
+
+    def merge(self, values):
+        for key, (counts, total, count) in values:
+            series = self.values.setdefault(tuple(key), [[0] * len(self.buckets), 0.0, 0])
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+            series[2] += count
+
+    def render(self):
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels, key, [("le", format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+
+        return lines
+
+
+# Текст всех метрик для /metrics
+def render(registry=REGISTRY):
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Снимок метрик процесса в JSON
+def snapshot(registry=REGISTRY):
+    return json.dumps([metric.dump() for metric in registry], ensure_ascii=False)
+
+
+# Складываем снимки нескольких процессов в новый набор метрик
+def merge(snapshots):
+
+    registry = []
+    metrics = {}
+
+    for data in snapshots:
+        for item in json.loads(data):
+            metric = metrics.get(item["name"])
+            if metric is None:
+                if item["kind"] == Histogram.kind:
+                    metric = Histogram(item["name"], item["help"], item["labels"], item["buckets"], registry=registry)
+                else:
+                    metric = Counter(item["name"], item["help"], item["labels"], registry=registry)
+                metrics[item["name"]] = metric
+            metric.merge(item["values"])
+
+    return registry
+
+
+handler_seconds = Histogram("bot_handler_seconds", "Время обработки апдейта обработчиком", ("bot", "handler"))
+handler_errors = Counter("bot_handler_errors_total", "Исключения в обработчиках", ("bot", "handler"))
+query_seconds = Histogram("db_query_seconds", "Время выполнения запроса к БД", ("operation",))
+report_submissions = Counter("report_submissions_total", "Принятые отчеты по временным диапазонам", ("window",))
+cache_requests = Counter("cache_requests_total", "Обращения к кэшам процесса", ("cache", "result"))
+
+
+#
+# Задержки обработчиков
+#
+
+# Внутренний middleware: вызывается уже для выбранного обработчика
+class LatencyMiddleware(BaseMiddleware):
+
+    def __init__(self, bot_name):
+        self.bot_name = bot_name
+
+    async def __call__(self, handler, event, data):
+
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(bot=self.bot_name, handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, bot=self.bot_name, handler=name)
+
+
+# Подключаем замер задержек к обработчикам сообщений и кнопок диспетчера
+def setup_metrics(dp, bot_name):
+    middleware = LatencyMiddleware(bot_name)
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
+
+
+#
+# Время запросов к БД
+#
+
+# Замеряем каждый запрос движка по событиям SQLAlchemy
+def track_queries(engine):
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_started = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_started", None)
+        if started is not None:
+            operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+            query_seconds.observe(time.perf_counter() - started, operation=operation)
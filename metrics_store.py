@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+from database import async_session, dialect_insert, read_session
+from datetime import datetime, timedelta
+from db_store import metrics_snapshots
+from metrics import PROCESS, merge, render, snapshot
+from sqlalchemy import delete, select
+
+
+#
+# Метрики всех процессов на /metrics
+#
+# Процессы ботов (поллинг, рабочие процессы sharding.py, веб-процесс
+# в режиме вебхука) раз в flush_interval секунд записывают снимок своих
+# метрик в таблицу metrics_snapshots, а /metrics веб-процесса складывает
+# снимки всех процессов со своими метриками. Снимки процессов, которые
+# не обновлялись SNAPSHOT_TTL секунд, удаляются: для Prometheus это
+# сброс счетчиков, как после перезапуска процесса.
+#
+
+logger = logging.getLogger(__name__)
+
+# Период записи снимка, с
+FLUSH_INTERVAL = 15.0
+# Через сколько секунд без обновления снимок процесса удаляется
+SNAPSHOT_TTL = 3600
+
+_task = None
+
+
+# Записываем снимок метрик процесса
+async def publish():
+
+    now = datetime.now()
+    async with async_session() as db:
+        query = dialect_insert(db, metrics_snapshots).values(process=PROCESS, updated=now, data=snapshot())
+        query = query.on_conflict_do_update(index_elements=[metrics_snapshots.c.process],
+                                            set_=dict(updated=query.excluded.updated, data=query.excluded.data)
+                                            )
+        await db.execute(query)
+        await db.execute(delete(metrics_snapshots)
+                         .where(metrics_snapshots.c.updated < now - timedelta(seconds=SNAPSHOT_TTL))
+                         )
+        await db.commit()
+
+
+async def publish_loop(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await publish()
+        except Exception:
+            logger.exception("Не удалось записать метрики процесса")
+
+
+# Запускаем запись снимков (один раз на процесс, даже если в нем оба бота)
+def start_publishing(interval=FLUSH_INTERVAL):
+    global _task
+
+    if _task is None or _task.done():
+        _task = asyncio.create_task(publish_loop(interval))
+
+
+# Останавливаем запись и записываем последний снимок (до закрытия соединений с БД)
+async def stop_publishing():
+    global _task
+
+    if _task is None:
+        return
+
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+
+    try:
+        await publish()
+    except Exception:
+        logger.exception("Не удалось записать метрики процесса")
+
+
+# Метрики этого процесса вместе со снимками остальных
+async def render_all():
+
+    async with read_session() as db:
+        snapshots = (await db.execute(select(metrics_snapshots.c.data)
+                                      .where(metrics_snapshots.c.process != PROCESS,
+                                             metrics_snapshots.c.updated >= datetime.now() - timedelta(seconds=SNAPSHOT_TTL)
+                                             )
+                                      )).scalars().all()
+
+    return render(merge([snapshot(), *snapshots]))
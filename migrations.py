@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import sys
+
+from database import dispose_engine, get_async_engine
+from datetime import datetime
+from db_store import SUBMISSION_KEY, Base, Reports, Users, archive_runs, fsm_states, report_revisions
+from db_store import metrics_snapshots, schema_version, window_totals
+from sqlalchemy import and_, bindparam, delete, func, insert, inspect, select, text, update
+from sqlalchemy.schema import CreateIndex
+from time_range import TimeRange
+
+
+#
+# Миграции схемы БД
+#
+# Номер версии - позиция миграции в списке MIGRATIONS (начиная с 1).
+# Примененные версии записываются в таблицу schema_version, при старте
+# выполняются только новые. Миграции не должны падать на базе, где их
+# изменения уже есть (например, созданной старой версией ботов).
+#
+
+logger = logging.getLogger(__name__)
+
+
+# 1. Пользователи и отчеты
+def create_tables(conn):
+    Base.metadata.create_all(conn, tables=[Users.__table__, Reports.__table__])
+
+
+# Создаем индексы отчетов по именам, если их еще нет.
+# IF NOT EXISTS, а не checkfirst: индексы по выражениям SQLite не отражает
+def create_report_indexes(conn, *names):
+    for index in Reports.__table__.indexes:
+        if index.name in names:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+# 2. Индексы по дате отчета
+def create_date_indexes(conn):
+    create_report_indexes(conn, 'ix_reports_date', 'ix_reports_store_date')
+
+
+# 3. Накопительные суммы, заполняются по существующим отчетам
+def create_window_totals(conn):
+    from window_totals import rebuild
+
+    if not inspect(conn).has_table(window_totals.name):
+        window_totals.create(conn)
+        rebuild(conn)
+
+
+# 4. Номер временного диапазона в отчетах
+def add_report_bucket(conn):
+
+    columns = [column["name"] for column in inspect(conn).get_columns(Reports.__tablename__)]
+    if "bucket" not in columns:
+        conn.execute(text("ALTER TABLE reports ADD COLUMN bucket INTEGER"))
+
+    create_report_indexes(conn, 'ix_reports_bucket')
+    backfill_buckets(conn, only_missing=True)
+
+
+# 5. Состояния FSM
+def create_fsm_states(conn):
+    fsm_states.create(conn, checkfirst=True)
+
+
+# 6. Один отчет на пользователя, магазин и смену: повторы сворачиваются
+# в последний отчет, прежние значения переносятся в report_revisions
+def deduplicate_reports(conn):
+    from window_totals import rebuild
+
+    report_revisions.create(conn, checkfirst=True)
+
+    if fold_duplicates(conn):
+        rebuild(conn)
+
+    create_report_indexes(conn, 'ux_reports_submission')
+
+
+# 7. Журнал архивации отчетов
+def create_archive_runs(conn):
+    archive_runs.create(conn, checkfirst=True)
+
+
+# 8. Снимки метрик процессов
+def create_metrics_snapshots(conn):
+    metrics_snapshots.create(conn, checkfirst=True)
+
+
+MIGRATIONS = [
+    create_tables,
+    create_date_indexes,
+    create_window_totals,
+    add_report_bucket,
+    create_fsm_states,
+    deduplicate_reports,
+    create_archive_runs,
+    create_metrics_snapshots,
+]
+
+
+# Сворачиваем отчеты с одинаковым ключом (пользователь, магазин, смена)
+# в последний из них, прежние значения переносим в report_revisions
+def fold_duplicates(conn):
+
+    reports = Reports.__table__
+    latest = reports.alias("latest")
+    latest_key = [latest.c.user, func.coalesce(latest.c.store, ''), latest.c.bucket]
+
+    # Последний отчет с тем же ключом
+    latest_id = (select(func.max(latest.c.reports_id))
+                 .where(*[column == latest_column for column, latest_column in zip(SUBMISSION_KEY, latest_key)])
+                 .scalar_subquery()
+                 )
+    duplicate = and_(reports.c.user.is_not(None), 
+                     reports.c.bucket.is_not(None), 
+                     reports.c.reports_id < latest_id
+                     )
+
+    conn.execute(insert(report_revisions).from_select(["reports_id", "sales", "remainings", "date"],
+                                                      select(latest_id, reports.c.sales, reports.c.remainings, reports.c.date)
+                                                      .where(duplicate)
+                                                      .order_by(reports.c.reports_id)
+                                                      ))
+    removed = conn.execute(delete(reports).where(duplicate)).rowcount
+
+    if removed:
+        logger.info("Удалено повторных отчетов: %d", removed)
+
+    return removed
+
+
+# Рассчитываем номера диапазонов отчетов по текущему графику смен
+def backfill_buckets(conn, only_missing=False, chunk_size=10000):
+
+    reports = Reports.__table__
+    query = select(reports.c.reports_id, reports.c.date).where(reports.c.date.is_not(None))
+    if only_missing:
+        query = query.where(reports.c.bucket.is_(None))
+
+    statement = (update(reports)
+                 .where(reports.c.reports_id == bindparam("id"))
+                 .values(bucket=bindparam("new_bucket"))
+                 )
+
+    count = 0
+    last_id = 0
+
+    # Обновляем отчеты частями по возрастанию номера
+    while True:
+        rows = conn.execute(query.where(reports.c.reports_id > last_id)
+                            .order_by(reports.c.reports_id)
+                            .limit(chunk_size)
+                            ).all()
+        if not rows:
+            break
+
+        conn.execute(statement, [dict(id=reports_id, new_bucket=TimeRange.calculate_range(date).bucket)
+                                 for reports_id, date in rows
+                                 ])
+        count += len(rows)
+        last_id = rows[-1].reports_id
+
+    return count
+
+
+# После смены графика: пересчитываем номера диапазонов и накопительные суммы.
+# Отчеты объединенных смен получают одинаковый ключ: уникальный индекс
+# снимаем на время пересчета, повторы сворачиваем как в миграции 6
+def rebucket(conn):
+    from window_totals import rebuild
+
+    conn.execute(text("DROP INDEX IF EXISTS ux_reports_submission"))
+    count = backfill_buckets(conn)
+    fold_duplicates(conn)
+    create_report_indexes(conn, 'ux_reports_submission')
+    rebuild(conn)
+    return count
+
+
+# Применяем недостающие миграции (синхронное соединение)
+def migrate(conn):
+
+    schema_version.create(conn, checkfirst=True)
+    current = conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        migration(conn)
+        conn.execute(insert(schema_version).values(version=version, applied=datetime.now()))
+        logger.info("Применена миграция %d: %s", version, migration.__name__)
+
+    return len(MIGRATIONS)
+
+
+# Применяем миграции к БД общего движка
+async def migrate_database(engine=None):
+    async with (engine or get_async_engine()).begin() as conn:
+        return await conn.run_sync(migrate)
+
+
+# Миграции из командной строки: python migrations.py [rebucket]
+async def main():
+    try:
+        print(f"Версия схемы: {await migrate_database()}")
+
+        if "rebucket" in sys.argv[1:]:
+            async with get_async_engine().begin() as conn:
+                print(f"Пересчитано отчетов: {await conn.run_sync(rebucket)}")
+    finally:
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+
+#
+# Отложенная пакетная запись отчетов
+#
+# Отчеты из обработчиков складываются в очередь и записываются в БД
+# одной транзакцией по max_batch строк или раз в max_delay секунд.
+# Обработчик ждет, пока транзакция с его отчетом будет зафиксирована.
+# Отчеты, переданные вместе (submit_many), попадают в одну транзакцию.
+# Сами запросы выполняет write(db, values) внутри транзакции
+# (например, submissions.save_reports).
+#
+
+logger = logging.getLogger(__name__)
+
+
+class ReportWriter:
+
+    def __init__(self, session_factory, write, max_batch=200, max_delay=0.05):
+
+        self.session_factory = session_factory
+        self.write = write
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.commits = 0
+        self.rows = 0
+        self._queue = None
+        self._task = None
+        self._closing = False
+
+    # Запускаем фоновую задачу записи
+    def start(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    # Ставим отчет в очередь и ждем фиксации транзакции
+    async def submit(self, values):
+        return await self.submit_many([values])
+
+    # Ставим несколько отчетов в очередь и ждем фиксации общей транзакции
+    async def submit_many(self, rows):
+        if self._closing:
+            raise RuntimeError("ReportWriter is closed")
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((rows, future))
+        return await future
+
+    # Записываем все, что осталось в очереди, и останавливаем задачу
+    async def close(self):
+        if self._task is None:
+            return
+        self._closing = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    # Собираем пакет: ждем первый отчет, затем добираем до max_batch или max_delay
+    async def _collect(self):
+        item = await self._queue.get()
+        if item is None:
+            return [], True
+
+        batch = [item]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            try:
+                if timeout > 0:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    async def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = await self._collect()
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch):
+        try:
+            async with self.session_factory() as db:
+                await self.write(db, [values for rows, _ in batch for values in rows])
+                await db.commit()
+        except Exception as error:
+            logger.exception("Не удалось записать пакет из %d отчетов", sum(len(rows) for rows, _ in batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        self.commits += 1
+        self.rows += sum(len(rows) for rows, _ in batch)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
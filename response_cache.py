@@ -0,0 +1,85 @@
+import logging
+import sys
+
+from collections import OrderedDict
+from metrics import cache_requests
+
+
+#
+# Кэш готовых ответов с ограничением по занимаемой памяти
+#
+
+logger = logging.getLogger(__name__)
+
+
+# Приблизительный размер значения в байтах
+def value_size(value):
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(value_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+# LRU-кэш: при превышении max_bytes вытесняются давно не запрошенные ответы
+class ResponseCache:
+
+    def __init__(self, name, max_bytes=4 * 1024 * 1024):
+
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key):
+
+        item = self._items.get(key)
+
+        if item is None:
+            self.misses += 1
+            cache_requests.inc(cache=self.name, result="miss")
+            logger.info("Кэш %s: промах %s (попаданий %.0f%%)", self.name, key, self.hit_rate * 100)
+            return None
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        cache_requests.inc(cache=self.name, result="hit")
+        logger.info("Кэш %s: попадание %s (попаданий %.0f%%)", self.name, key, self.hit_rate * 100)
+        return item[0]
+
+    def put(self, key, value):
+
+        size = value_size(value)
+
+        # Слишком большой ответ не кэшируем
+        if size > self.max_bytes:
+            return
+
+        self.invalidate(key)
+        self._items[key] = (value, size)
+        self.bytes += size
+
+        # Вытесняем давно не запрошенные ответы
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def invalidate(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def clear(self):
+        self._items.clear()
+        self.bytes = 0
@@ -1,102 +1,122 @@
 import asyncio
+import html
 import logging
+import os
 import re
+import tempfile
 
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message
+from aiogram.types import FSInputFile, Message
+from archive import archived_before
 from config_reader import config
-from datetime import datetime
-from sqlalchemy import DateTime, Integer, Text, ForeignKey
-from sqlalchemy import create_engine, select
-from sqlalchemy.orm import DeclarativeBase, Mapped, Session
-from sqlalchemy.orm import mapped_column, relationship
-from typing import List, Optional
+from database import archive_session, async_session, dispose_engine, read_session
+from datetime import datetime, timedelta
+from db_store import Reports
+from export import EXPORT_FORMATS, export_reports
+from fsm_storage import DatabaseStorage
+from log_queue import setup_logging
+from metrics import setup_metrics
+from metrics_store import start_publishing, stop_publishing
+from migrations import migrate_database
+from response_cache import ResponseCache
+from send_queue import setup_send_queue
+from sqlalchemy import func, select
+from throttling import setup_throttling
+from time_range import WINDOW_CLOSE_DELAY, TimeRange
+from window_totals import totals_for_window
 
 
-# Адрес БД
-sqlite_database = config.database_address.get_secret_value()
-# Cоздаем движок SqlAlchemy
-engine = create_engine(sqlite_database, echo=False)
+# Кэш отчетов за закрытые временные диапазоны
+window_cache = ResponseCache("reports_in_range", max_bytes=config.window_cache_bytes)
 
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+# Наибольшее количество отчетов на одной странице списка
+PAGE_ROWS = 25
 
-class Base(DeclarativeBase):
-    pass
+# Ограничение Telegram на размер документа, отправляемого ботом
+DOCUMENT_LIMIT = 50 * 1024 * 1024
+# Одновременных выгрузок в процессе
+EXPORT_CONCURRENCY = 2
+export_limit = asyncio.Semaphore(EXPORT_CONCURRENCY)
 
+# Период аналитики по умолчанию и наибольший, дни
+ANALYTICS_DAYS = 28
+ANALYTICS_MAX_DAYS = 366
 
-class Users(Base):
-    __tablename__ = 'users'
+EXPORT_USAGE = ("Выгрузка отчётов: /export день.месяц.год день.месяц.год [csv|xlsx]\n"
+                "Например: /export 01.06.2025 30.06.2025 xlsx")
 
-    tg_id: Mapped[Optional[int]] = mapped_column(Integer, primary_key=True)
-    name: Mapped[Optional[int]] = mapped_column(Text)
-    store: Mapped[Optional[int]] = mapped_column(Text)
+SEPARATOR       = "─────────────────────────────"
+ROW_SEPARATOR   = "┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈"
 
-    reports: Mapped[List['Reports']] = relationship('Reports', back_populates='users')
 
+# Название магазина для сообщения: названия из пакетных отчетов - произвольный
+# текст, а сообщения бота размечены HTML
+def store_name(store):
+    return html.escape(str(store))
 
-class Reports(Base):
-    __tablename__ = 'reports'
 
-    reports_id: Mapped[Optional[int]] = mapped_column(Integer, primary_key=True)
-    sales: Mapped[Optional[int]] = mapped_column(Integer)
-    remainings: Mapped[Optional[int]] = mapped_column(Integer)
-    user: Mapped[Optional[int]] = mapped_column(ForeignKey('users.tg_id'))
-    username: Mapped[Optional[int]] = mapped_column(Integer)
-    store: Mapped[Optional[str]] = mapped_column(Text)
-    date: Mapped[Optional[str]] = mapped_column(DateTime)
+# Собираем строки в сообщения, не превышающие ограничение Telegram
+def split_message(lines, limit=MESSAGE_LIMIT):
 
-    users: Mapped[Optional['Users']] = relationship('Users', back_populates='reports')
+    chunks = []
+    buffer = []
+    size = 0
 
+    for line in lines:
+        line = line[:limit]
+        # Учитываем перевод строки после каждой строки
+        if buffer and size + len(line) + 1 > limit:
+            chunks.append("\n".join(buffer))
+            buffer = []
+            size = 0
+        buffer.append(line)
+        size += len(line) + 1
 
-# Cоздаем таблицы
-Base.metadata.create_all(bind=engine)
+    if buffer:
+        chunks.append("\n".join(buffer))
 
-#
-# Диапазон времени на основании текущего и трех значений
-#
-class TimeRange:
+    return chunks
 
 
-    def __init__(self, start, end, range):
+# Данные закрытого диапазона больше не меняются, поэтому берем их из кэша
+async def cached_window(key, time_range, render):
 
-        self.start = start
-        self.end = end
-        self.range = range
-    
-    def calculate_range(date):
+    closed = time_range.end + WINDOW_CLOSE_DELAY < datetime.now()
+    value = window_cache.get(key) if closed else None
 
-        year    = date.year
-        month   = date.month
-        day     = date.day
-        hour    = date.hour
-        range   = ""
+    if value is None:
+        value = await render()
+        if closed:
+            window_cache.put(key, value)
 
-        if hour < 12:
+    return value
 
-            start   = datetime(year, month, day, 0, 0, 0)
-            end     = datetime(year, month, day, 11, 59, 59, 999999) 
-            range   = "1. С 00:00 до 12:00"
 
-        elif hour < 18:
+# Итоговые строки сводки за диапазон
+def summary_footer(time_range, sales_sum, remainings_sum, current_date = None):
 
-            start   = datetime(year, month, day, 12, 0, 0)
-            end     = datetime(year, month, day, 17, 59, 59, 999999) 
-            range   =  "2. С 12:00 до 18:00"
+    lines = [SEPARATOR]
+    if current_date is not None:
+        lines.append("  <b>Дата: " + str(current_date) + "</b>")
+    lines.append("  <b>Временной диапазон №"    + str(time_range.range) + "</b>")
+    lines.append(SEPARATOR)
+    lines.append("  <b>Итого продаж:     "       + str(sales_sum)        + "</b>")
+    lines.append("  <b>Итого остатков:  "        + str(remainings_sum)   + "</b>")
+    lines.append(SEPARATOR)
 
-        else:
-            
-            start   = datetime(year, month, day, 18, 0, 0)
-            end     = datetime(year, month, day, 23, 59, 59, 999999) 
-            range   = "3. С 18:00 до 00:00"
-        
-        return TimeRange(start, end, range)
+    return lines
 
 
-def reports_in_range(db, current_date = None):
+# Сводка за диапазон: суммы по магазинам и итоги (список сообщений)
+async def reports_in_range(db, current_date = None, title = None):
 
     if current_date is None:
         # Текущее время
@@ -108,44 +128,232 @@ def reports_in_range(db, current_date = None):
 
     time_range = TimeRange.calculate_range(now)
 
-    # Запрос на записи за определенный промежуток времени 
-    query = select(Reports).where(Reports.date.between(time_range.start, time_range.end))
+    stores, sales_sum, remainings_sum = await cached_window((time_range.start, time_range.end), 
+                                                            time_range, 
+                                                            lambda: window_summary(db, time_range)
+                                                            )
 
-    # Выполнение запроса
-    reports = db.execute(query).scalars().all()
+    lines = []
+    if title is not None:
+        lines.append(f"<b>{title}</b>")
 
-    # Сумма по продажам
-    sales_sum = 0
+    # Вывод сумм по магазинам
+    if stores:
+        lines.append(SEPARATOR)
+        lines.append("  <b>По магазинам:</b>")
+    for store, sales, remainings, count in stores:
+        lines.append(f"{store_name(store)}: продажи {sales}, остатки {remainings} (отчётов: {count})")
 
-    # Сумма по остаткам
-    remainings_sum = 0
+    lines += summary_footer(time_range, sales_sum, remainings_sum, current_date)
 
-    reports_str = ""        
+    return split_message(lines)
 
-    # Вывод результатов
-    for report in reports:
-        report_store         = str(report.store)
-        report_date          = str(report.date.strftime("%d.%m.%Y %H:%M"))
-        report_sales         = str(report.sales)
-        report_remainings    = str(report.remainings)  
-        reports_str +=   "┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈┈\n"              
-        reports_str += (f"Магазин: {report_store}\n")
-        reports_str += (f"Дата: {report_date}\n")
-        reports_str += (f"Продажи: {report_sales}, Остатки: {report_remainings}\n")
-        sales_sum       += report.sales
-        remainings_sum  += report.remainings        
 
+# Отчеты диапазона перенесены в архивную БД (см. archive.py)
+async def is_archived(db, time_range):
+    boundary = await archived_before(db)
+    return boundary is not None and time_range.end < boundary
 
-    reports_str     +=   "─────────────────────────────\n"              
-    if current_date is not None:
-        reports_str +=   "  <b>Дата: " + str(current_date) + "</b>\n"
-    reports_str     +=   "  <b>Временной диапазон №"    + str(time_range.range) + "</b>\n"
-    reports_str     +=  "─────────────────────────────\n" 
-    reports_str     +=  "  <b>Итого продаж:     "       + str(sales_sum)        + "</b>\n"
-    reports_str     +=  "  <b>Итого остатков:  "        + str(remainings_sum)   + "</b>\n"
-    reports_str     +=  "─────────────────────────────"
 
-    return reports_str
+# Суммы по магазинам и итоговые суммы за архивный диапазон: по накопительным суммам
+async def archived_summary(db, time_range):
+
+    stores = [(store.store or None, store.sales, store.remainings, store.reports)
+              for store in await totals_for_window(db, time_range.start)
+              ]
+
+    return stores, sum(store[1] for store in stores), sum(store[2] for store in stores)
+
+
+# Суммы по магазинам и итоговые суммы за диапазон
+async def window_summary(db, time_range):
+
+    if await is_archived(db, time_range):
+        return await archived_summary(db, time_range)
+
+    # Суммы по продажам и остаткам считаем на стороне БД
+    sales_sum, remainings_sum = (await db.execute(select(func.coalesce(func.sum(Reports.sales), 0), 
+                                                         func.coalesce(func.sum(Reports.remainings), 0)
+                                                         )
+                                                  .where(Reports.bucket == time_range.bucket)
+                                                  )).one()
+
+    # Суммы в разрезе магазинов
+    stores = [tuple(store) for store in await store_totals_in_range(db, time_range)]
+
+    return stores, sales_sum, remainings_sum
+
+
+# Суммы продаж и остатков по каждому магазину за промежуток времени
+async def store_totals_in_range(db, time_range):
+
+    query = (select(Reports.store,
+                    func.coalesce(func.sum(Reports.sales), 0).label("sales"),
+                    func.coalesce(func.sum(Reports.remainings), 0).label("remainings"),
+                    func.count().label("reports")
+                    )
+             .where(Reports.bucket == time_range.bucket)
+             .group_by(Reports.store)
+             .order_by(Reports.store)
+             )
+
+    return (await db.execute(query)).all()
+
+
+# Страница списка отчетов за диапазон: отчеты с номером больше after_id
+async def reports_page(db, time_range, after_id = 0):
+
+    # Отчеты архивного диапазона читаем из архивной БД
+    async def render():
+        if await is_archived(db, time_range):
+            async with archive_session() as archive_db:
+                return await render_page(archive_db, time_range, after_id)
+        return await render_page(db, time_range, after_id)
+
+    return await cached_window((time_range.start, time_range.end, after_id), time_range, render)
+
+
+# Читаем отчеты из курсора, пока страница помещается в одно сообщение.
+# Возвращаем текст страницы и номер отчета, с которого начнется следующая
+async def render_page(db, time_range, after_id):
+
+    # Записи за промежуток: только нужные столбцы, без объектов ORM
+    query = (select(Reports.reports_id,
+                    Reports.store, 
+                    Reports.date, 
+                    Reports.sales, 
+                    Reports.remainings
+                    )
+             .where(Reports.bucket == time_range.bucket, 
+                    Reports.reports_id > after_id
+                    )
+             .order_by(Reports.reports_id)
+             .limit(PAGE_ROWS + 1)
+             )
+
+    lines = ["  <b>Отчёты, временной диапазон №" + str(time_range.range) + "</b>"]
+    size = len(lines[0]) + 1
+    rows = 0
+    last_id = None
+    next_after = None
+
+    result = await db.stream(query)
+    try:
+        async for report in result:
+            report_lines = [ROW_SEPARATOR,
+                            f"Магазин: {store_name(report.store)}",
+                            f"Дата: {report.date.strftime('%d.%m.%Y %H:%M')}",
+                            f"Продажи: {report.sales}, Остатки: {report.remainings}",
+                            ]
+            report_size = sum(len(line) + 1 for line in report_lines)
+
+            # Страница заполнена: следующая начнется после последнего выведенного отчета
+            if rows == PAGE_ROWS or size + report_size > MESSAGE_LIMIT:
+                next_after = last_id
+                break
+
+            lines += report_lines
+            size += report_size
+            rows += 1
+            last_id = report.reports_id
+    finally:
+        await result.close()
+
+    if rows == 0:
+        lines.append("Отчётов нет")
+
+    return "\n".join(lines), next_after
+
+
+# Сводка за текущий диапазон по накопительным суммам (без чтения отчетов)
+async def current_summary(db):
+
+    time_range = TimeRange.calculate_range(datetime.now())
+    stores = await totals_for_window(db, time_range.start)
+
+    sales_sum = sum(store.sales for store in stores)
+    remainings_sum = sum(store.remainings for store in stores)
+
+    lines = []
+
+    # Вывод сумм по магазинам
+    for store in stores:
+        lines.append(ROW_SEPARATOR)
+        lines.append(f"Магазин: {store_name(store.store or None)}")
+        lines.append(f"Продажи: {store.sales}, Остатки: {store.remainings} (отчётов: {store.reports})")
+
+    lines += summary_footer(time_range, sales_sum, remainings_sum)
+
+    return split_message(lines)
+
+
+# Изменение продаж для вывода: +5.2% или "нет данных"
+def format_change(value, previous):
+    from analytics import percent_change
+
+    change = percent_change(value, previous)
+    return "нет данных" if change is None else f"{change:+.1f}%"
+
+
+# Аналитика продаж и остатков по магазинам за последние days дней (список сообщений)
+async def analytics_report(db, days = ANALYTICS_DAYS, today = None):
+
+    # NumPy загружается при первом запросе аналитики, а не при старте бота
+    from analytics import ROLLING_DAYS, analyse, load_reports
+
+    end = datetime.combine((today or datetime.now()).date(), datetime.min.time()) + timedelta(days=1)
+    start = end - timedelta(days=days)
+
+    # Начало периода в архиве: отчеты читаем и из него
+    boundary = await archived_before(db)
+    if boundary is not None and start < boundary:
+        async with archive_session() as archive_db:
+            arrays = await load_reports(db, start, end, archive=archive_db)
+    else:
+        arrays = await load_reports(db, start, end)
+    analysis = await asyncio.to_thread(analyse, arrays, start, days)
+
+    lines = [f"  <b>Аналитика за {days} дн. (по {end - timedelta(days=1):%d.%m.%Y})</b>"]
+
+    for trend in analysis.trends:
+        lines.append(ROW_SEPARATOR)
+        lines.append(f"Магазин: {store_name(trend.store or None)}")
+        lines.append(f"Продажи за неделю: {trend.week} ({format_change(trend.week, trend.previous_week)})")
+        lines.append(f"Последняя смена: {trend.shift_sales}, неделю назад {trend.last_week_shift_sales} "
+                     f"({format_change(trend.shift_sales, trend.last_week_shift_sales)})")
+        lines.append(f"Среднее за {ROLLING_DAYS} дн.: {trend.average:.1f}")
+
+    if not analysis.trends:
+        lines.append("Отчётов нет")
+
+    if analysis.outliers:
+        lines.append(SEPARATOR)
+        lines.append("  <b>Выбросы:</b>")
+    for outlier in analysis.outliers:
+        lines.append(f"{outlier.date.astype(object):%d.%m.%Y} {store_name(outlier.store or None)}: "
+                     f"{outlier.kind} {outlier.value}, ожидалось ~{outlier.expected:.0f}")
+
+    return split_message(lines)
+
+
+# Период выгрузки из аргументов команды: начало, конец (не включая) и формат
+def parse_export_args(args):
+
+    parts = (args or "").split()
+    if len(parts) not in (2, 3):
+        return None
+
+    format = parts[2].lower() if len(parts) == 3 else "csv"
+    try:
+        start = datetime.strptime(parts[0], "%d.%m.%Y")
+        end = datetime.strptime(parts[1], "%d.%m.%Y") + timedelta(days=1)
+    except ValueError:
+        return None
+
+    if start >= end or format not in EXPORT_FORMATS:
+        return None
+
+    return start, end, format
 
 
 def validate_date_time(input_str):
@@ -158,14 +366,30 @@ def validate_date_time(input_str):
 # Telegram id администратора
 admin_id = config.admin_id.get_secret_value()
 
-# # Включаем логирование
-logging.basicConfig(level=logging.INFO)
+# Включаем логирование через очередь
+setup_logging()
 
 # Создаем объект бота
 bot = Bot(token=config.results_bot_token.get_secret_value(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-# Создаем диспетчер бота
-dp = Dispatcher()
+# Очередь исходящих сообщений: ответы бота и рассылка итогов смены
+outgoing = setup_send_queue(bot)
+
+# Задача рассылки итогов (запускается при старте бота)
+digest_task = None
+
+# Создаем диспетчер бота, состояния FSM хранятся в БД
+dp = Dispatcher(storage=DatabaseStorage(async_session,
+                                        flush_interval=config.fsm_flush_interval,
+                                        memory_ttl=config.fsm_memory_ttl,
+                                        ttl=config.fsm_ttl
+                                        ))
+
+# Замеряем задержки обработчиков
+setup_metrics(dp, "results")
+
+# Отбрасываем повторные нажатия
+setup_throttling(dp, "results", config.throttle_interval)
 
 # 
 # Создаём клавиатуры
@@ -186,6 +410,34 @@ def go_back_keyboard():
     keyboard = types.ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
     return keyboard
 
+# Кнопки перелистывания списка отчетов
+class ReportsPage(CallbackData, prefix="page"):
+    # Начало временного диапазона (timestamp)
+    start: int
+    # Номер отчета, после которого начинается страница
+    after: int
+
+# Инлайн-клавиатура страницы списка отчетов
+def page_keyboard(time_range, after_id, next_after):
+    start = int(time_range.start.timestamp())
+    buttons = []
+    if after_id:
+        buttons.append(types.InlineKeyboardButton(text="⏮ В начало", 
+                                                  callback_data=ReportsPage(start=start, after=0).pack()
+                                                  ))
+    if next_after is not None:
+        buttons.append(types.InlineKeyboardButton(text="Далее ▶", 
+                                                  callback_data=ReportsPage(start=start, after=next_after).pack()
+                                                  ))
+    if not buttons:
+        return None
+    return types.InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+# Отправляем сводку несколькими сообщениями, клавиатура - у последнего
+async def answer_chunks(message, chunks, reply_markup=None):
+    for number, chunk in enumerate(chunks, start=1):
+        await message.answer(chunk, reply_markup=reply_markup if number == len(chunks) else None)
+
 # Создаем машину состояний
 class Form(StatesGroup):
     time_change = State()  
@@ -204,20 +456,71 @@ async def start(message: types.Message, state: FSMContext) -> None:
     
 
 @dp.message(F.text == 'Суммы сейчас')
-async def set_balance(message: types.Message, state: FSMContext) -> None:    
+async def show_current(message: types.Message, state: FSMContext) -> None:    
     await state.update_data(summary = message.text)  
-    with Session(autoflush=False, bind=engine) as db: 
-        await message.answer(reports_in_range(db), reply_markup=go_back_keyboard())
+    async with read_session() as db: 
+        chunks = await current_summary(db)
+    await answer_chunks(message, chunks, reply_markup=go_back_keyboard())
 
 
 @dp.message(F.text == 'Другая дата')
-async def set_balance(message: types.Message, state: FSMContext) -> None:
+async def ask_date(message: types.Message, state: FSMContext) -> None:
     await state.set_state(Form.time_change)    
     await message.answer("Укажите дату в формате: день.месяц.год час:минута", 
                          reply_markup=go_back_keyboard()
                          )
     
 
+# Выгружаем отчеты за период документом
+@dp.message(Command("export"))
+async def export_command(message: Message, command: CommandObject) -> None:
+
+    period = parse_export_args(command.args)
+    if period is None:
+        await message.answer(EXPORT_USAGE)
+        return
+
+    start, end, format = period
+    name = f"reports_{start:%Y%m%d}_{end - timedelta(days=1):%Y%m%d}.{format}"
+
+    async with export_limit:
+        with tempfile.TemporaryDirectory(prefix="export_") as directory:
+            path = os.path.join(directory, name)
+
+            try:
+                async with read_session() as db:
+                    # Начало периода в архиве: сначала выгружаем отчеты из него
+                    boundary = await archived_before(db)
+                    if boundary is not None and start < boundary:
+                        async with archive_session() as archive_db:
+                            count = await export_reports(db, start, end, path, format, archive=archive_db)
+                    else:
+                        count = await export_reports(db, start, end, path, format)
+            except ImportError:
+                await message.answer("Выгрузка в XLSX недоступна, используйте csv")
+                return
+
+            if os.path.getsize(path) > DOCUMENT_LIMIT:
+                await message.answer("Файл больше 50 МБ, выберите период короче")
+                return
+
+            await message.answer_document(FSInputFile(path), caption=f"Отчётов: {count}")
+
+
+# Аналитика по магазинам: /analytics [дней]
+@dp.message(Command("analytics"))
+async def analytics_command(message: Message, command: CommandObject) -> None:
+
+    days = command.args.strip() if command.args else str(ANALYTICS_DAYS)
+    if not days.isdigit() or not 1 <= int(days) <= ANALYTICS_MAX_DAYS:
+        await message.answer(f"Аналитика: /analytics [дней, от 1 до {ANALYTICS_MAX_DAYS}]")
+        return
+
+    async with read_session() as db:
+        chunks = await analytics_report(db, int(days))
+    await answer_chunks(message, chunks)
+
+
 @dp.message(F.text == "⏪ Вернуться назад")
 async def reply_message(message: types.Message, state: FSMContext) -> None:
     await state.set_state(Form.default)
@@ -232,22 +535,128 @@ async def time_change(message: Message, state: FSMContext) -> None:
     
     if validate_date_time(message.text):
         current_date = datetime.strptime(message.text, "%d.%m.%Y %H:%M")
-        print(current_date.year)
-        with Session(autoflush=False, bind=engine) as db: 
-            await message.answer(reports_in_range(db, current_date = current_date), reply_markup=go_back_keyboard())
+        time_range = TimeRange.calculate_range(current_date)
+        async with read_session() as db: 
+            page, next_after = await reports_page(db, time_range)
+            chunks = await reports_in_range(db, current_date = current_date)
+        await message.answer(page, reply_markup=page_keyboard(time_range, 0, next_after))
+        await answer_chunks(message, chunks, reply_markup=go_back_keyboard())
     else:
         await message.answer("Введите корректную дату в формате: день.месяц.год час:минута (01.01.2025 13:37)!", 
                              reply_markup=go_back_keyboard()
                              ) 
 
+# Перелистываем список отчетов
+@dp.callback_query(ReportsPage.filter())
+async def reports_page_callback(callback: types.CallbackQuery, callback_data: ReportsPage) -> None:
+    time_range = TimeRange.calculate_range(datetime.fromtimestamp(callback_data.start))
+    async with read_session() as db: 
+        page, next_after = await reports_page(db, time_range, callback_data.after)
+    await callback.message.edit_text(page, reply_markup=page_keyboard(time_range, callback_data.after, next_after))
+    await callback.answer()
+
 # Обрабатываем состояние "По умолчанию"
 @dp.message(Form.default)
 async def main_menu(message: Message, state: FSMContext) -> None:
     pass  
 
 
+# Получатели итогов смены: администратор и чаты из настроек
+def digest_recipients():
+    return list(dict.fromkeys([int(admin_id)] + config.digest_chat_ids))
+
+
+# Итоги закрытого диапазона. Сводка считается один раз и остается в кэше,
+# поэтому запросы этой смены через "Другая дата" в БД уже не идут
+async def send_shift_digest(time_range):
+
+    async with read_session() as db:
+        chunks = await reports_in_range(db, current_date=time_range.start, title="Итоги смены")
+
+    for chat_id in digest_recipients():
+        for chunk in chunks:
+            outgoing.put(chat_id, chunk)
+
+
+# Первая смена для рассылки итогов. Если процесс запущен в первые
+# WINDOW_CLOSE_DELAY после окончания смены (перезапуск на границе смен),
+# она еще не закрыта и ее итоги никто не отправлял - начинаем с нее
+def first_digest_range(current_time):
+
+    time_range = TimeRange.calculate_range(current_time)
+    previous = TimeRange.calculate_range(time_range.start - timedelta(microseconds=1))
+    if previous.end + WINDOW_CLOSE_DELAY >= current_time:
+        return previous
+
+    return time_range
+
+
+# Ждем окончания каждой смены и рассылаем ее итоги
+async def shift_digest_loop(now=datetime.now, sleep=asyncio.sleep):
+
+    time_range = first_digest_range(now())
+    while True:
+
+        # Диапазон считается закрытым через WINDOW_CLOSE_DELAY после окончания
+        delay = time_range.end + WINDOW_CLOSE_DELAY - now()
+        await sleep(max(delay.total_seconds(), 0) + 1)
+
+        try:
+            await send_shift_digest(time_range)
+        except Exception:
+            logging.exception("Не удалось подготовить итоги смены")
+
+        time_range = TimeRange.calculate_range(now())
+
+
+# Обновляем схему БД, запускаем запись метрик процесса и рассылку итогов при старте
+@dp.startup()
+async def on_startup() -> None:
+    global digest_task
+
+    await migrate_database()
+    start_publishing(config.metrics_flush_interval)
+    if config.shift_digest:
+        digest_task = asyncio.create_task(shift_digest_loop())
+
+
+# Останавливаем рассылку, отправляем оставшиеся сообщения
+# и закрываем соединения с БД при остановке
+@dp.shutdown()
+async def on_shutdown() -> None:
+    global digest_task
+
+    if digest_task is not None:
+        digest_task.cancel()
+        try:
+            await digest_task
+        except asyncio.CancelledError:
+            pass
+        digest_task = None
+
+    await outgoing.close()
+    await stop_publishing()
+    await dispose_engine()
+
+
 # Запуск процесса поллинга новых апдейтов
 async def main():
+
+    # В режиме вебхука апдейты принимает веб-процесс (web.py), а процесс
+    # поллинга не нужен (на Heroku: heroku ps:scale worker=0). Если он все же
+    # запущен, ждем остановки: при выходе Heroku перезапускал бы его по кругу
+    if config.bot_mode == "webhook":
+        logging.warning("Включен режим вебхука, поллинг не запускается: "
+                        "апдейты принимает web.py, этот процесс можно остановить")
+        await asyncio.Event().wait()
+
+    # Апдейты раздаются рабочим процессам по чатам
+    if config.workers > 1:
+        from sharding import run_front
+        await run_front("results", config.workers)
+        return
+
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 
@@ -9,74 +9,49 @@ from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message
+from bulk_reports import MAX_DOCUMENT_BYTES, MAX_LINES, bulk_summary, decode_document, parse_bulk
 from config_reader import config
+from database import async_session, dispose_engine, session_storage
 from datetime import datetime
-from sqlalchemy import DateTime, Integer, Text, ForeignKey
-from sqlalchemy import create_engine
-from sqlalchemy.orm import DeclarativeBase, Mapped, Session
-from sqlalchemy.orm import mapped_column, relationship
-from typing import List, Optional
+from db_store import Users
+from fsm_storage import DatabaseStorage
+from log_queue import setup_logging
+from metrics import report_submissions, setup_metrics
+from metrics_store import start_publishing, stop_publishing
+from migrations import migrate_database
+from report_writer import ReportWriter
+from send_queue import setup_send_queue
+from sqlalchemy import select
+from submissions import save_reports
+from throttling import setup_throttling
+from time_range import TimeRange
+from user_cache import CachedUser, UserCache
 
 
-#
-# Модель БД
-#
-
-class Base(DeclarativeBase):
-    pass
-
-
-class Users(Base):
-    __tablename__ = 'users'
-
-    tg_id: Mapped[Optional[int]] = mapped_column(Integer, primary_key=True)
-    name: Mapped[Optional[int]] = mapped_column(Text)
-    store: Mapped[Optional[int]] = mapped_column(Text)
-
-    reports: Mapped[List['Reports']] = relationship('Reports', back_populates='users')
+# Очередь пакетной записи отчетов
+report_writer = ReportWriter(async_session, save_reports)
 
 
-class Reports(Base):
-    __tablename__ = 'reports'
-
-    reports_id: Mapped[Optional[int]] = mapped_column(Integer, primary_key=True)
-    sales: Mapped[Optional[int]] = mapped_column(Integer)
-    remainings: Mapped[Optional[int]] = mapped_column(Integer)
-    user: Mapped[Optional[int]] = mapped_column(ForeignKey('users.tg_id'))
-    username: Mapped[Optional[int]] = mapped_column(Integer)
-    store: Mapped[Optional[str]] = mapped_column(Text)
-    date: Mapped[Optional[str]] = mapped_column(DateTime)
-
-    users: Mapped[Optional['Users']] = relationship('Users', back_populates='reports')
-
-
-# Адрес БД
-sqlite_database = config.database_address.get_secret_value()
-# Cоздаем движок 
-engine = create_engine(sqlite_database, echo=False)
-# Cоздаем таблицы
-Base.metadata.create_all(bind=engine)
+# Кэш пользователей: избавляет от запроса к БД на каждый /start.
+# Магазин пользователя для отчета всегда читается из БД (см. send_data)
+users_cache = UserCache(maxsize=config.user_cache_size, ttl=config.user_cache_ttl)
 
 
 # Добавляем пользователя в БД если отуствует
-def add_user(db, tg_id, name):
+async def add_user(db, tg_id, name):
 
-    # Проверяем наличие записи пользователя в БД
-    query = db.query(Users).filter(Users.tg_id==tg_id).first()
+    # Сначала ищем пользователя в кэше
+    user = users_cache.get(tg_id)
+    if user is not None:
+        return user
 
-    # Создаем объект пользователя
-    user = Users(tg_id=tg_id, name=name) 
+    # Добавляем пользователя, если записи еще нет, и получаем актуальную
+    # запись (магазин назначается отдельно)
+    row = await session_storage(db).add_user(db, tg_id, name)
+    await db.commit()
 
-    if query is None:   
-        # Добавляем пользователя в БД
-        db.add(user)
-        db.commit()
-        db.refresh(user) 
-        #print(f"Пользователь [{user.tg_id}] - {user.name} ({user.store}) добавлен в БД!") 
-
-    else: 
-        user = db.query(Users).filter(Users.tg_id==tg_id).first()
-        #print(f"Пользователь [{user.tg_id}] - {user.name} ({user.store}) найден в БД!") 
+    user = CachedUser(*row)
+    users_cache.put(user)
     
     return user
 
@@ -89,7 +64,8 @@ def add_user(db, tg_id, name):
 def main_keyboard():
     buttons = [
         [types.KeyboardButton(text="Ввести остатки и продажи")],
-        [types.KeyboardButton(text="Передать данные")]       
+        [types.KeyboardButton(text="Передать данные")],
+        [types.KeyboardButton(text="Несколько магазинов")]
     ]
     keyboard = types.ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
     return keyboard 
@@ -105,24 +81,40 @@ class Form(StatesGroup):
     sales = State()
     remainings = State()    
     default = State()
+    bulk = State()
 
 # Telegram id администратора
 admin_id = config.admin_id.get_secret_value()
 
-# Текущие продажи
-current_sales = 0
-# Текущие остатки
-current_remainings = 0
+
+# Черновик отчета пользователя: остатки и продажи хранятся в данных FSM,
+# отдельно для каждого чата, поэтому параллельные пользователи не мешают друг другу
+async def get_draft(state):
+    data = await state.get_data()
+    return int(data.get("remainings", 0)), int(data.get("sales", 0))
 
 
-# # Включаем логирование
-logging.basicConfig(level=logging.INFO)
+# Включаем логирование через очередь
+setup_logging()
 
 # Создаем объект бота
 bot = Bot(token=config.sales_bot_token.get_secret_value(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-# Создаем диспетчер бота
-dp = Dispatcher()
+# Ответы бота отправляются через очередь с ограничением скорости
+outgoing = setup_send_queue(bot)
+
+# Создаем диспетчер бота, состояния FSM хранятся в БД
+dp = Dispatcher(storage=DatabaseStorage(async_session,
+                                        flush_interval=config.fsm_flush_interval,
+                                        memory_ttl=config.fsm_memory_ttl,
+                                        ttl=config.fsm_ttl
+                                        ))
+
+# Замеряем задержки обработчиков
+setup_metrics(dp, "sales")
+
+# Отбрасываем повторные нажатия
+setup_throttling(dp, "sales", config.throttle_interval)
 
 
 # Обрабатываем команду "/start"
@@ -133,7 +125,7 @@ async def start(message: types.Message, state: FSMContext) -> None:
     await state.set_state(Form.default)
 
     # Cоздаем сессию подключения к бд
-    with Session(autoflush=False, bind=engine) as db:  
+    async with async_session() as db:  
 
         # Получаем id пользователя в telegram 
         user_tg_id = message.from_user.id   
@@ -142,7 +134,7 @@ async def start(message: types.Message, state: FSMContext) -> None:
         user_tg_name = message.from_user.username 
 
         # Добавляем пользователя в БД если отуствует       
-        user = add_user(db, 
+        user = await add_user(db, 
                         tg_id = user_tg_id, 
                         name = user_tg_name
                         )
@@ -156,7 +148,7 @@ async def start(message: types.Message, state: FSMContext) -> None:
 
 # Обрабатываем сообщение "Ввести остатки и продажи"
 @dp.message(F.text == 'Ввести остатки и продажи')
-async def set_balance(message: types.Message, state: FSMContext) -> None:
+async def ask_remainings(message: types.Message, state: FSMContext) -> None:
     await state.set_state(Form.remainings)
     await message.answer("Укажите текущие остатки:", 
                          reply_markup=go_back_keyboard()
@@ -165,77 +157,93 @@ async def set_balance(message: types.Message, state: FSMContext) -> None:
 
 # Обрабатываем сообщение "Продажи"
 @dp.message(F.text == 'Продажи')
-async def set_balance(message: types.Message, state: FSMContext) -> None:
+async def ask_sales(message: types.Message, state: FSMContext) -> None:
     await state.set_state(Form.sales)
     await message.answer("Укажите текущие продажи:", 
                          reply_markup=go_back_keyboard()
                          )
 
 
+# Обрабатываем сообщение "Несколько магазинов"
+@dp.message(F.text == 'Несколько магазинов')
+async def ask_bulk(message: types.Message, state: FSMContext) -> None:
+    await state.set_state(Form.bulk)
+    await message.answer("Отправьте отчёты по магазинам одним сообщением или CSV-файлом, "
+                         f"по строке на магазин (до {MAX_LINES}):\n"
+                         "магазин;остатки;продажи",
+                         reply_markup=go_back_keyboard()
+                         )
+
+
 @dp.message(F.text == 'Передать данные')
-async def send_data(message: types.Message):
+async def send_data(message: types.Message, state: FSMContext):
 
     #data = "Остатки:\t" + str(current_remainings) + "\nПродажи:\t" + str(current_sales)
     #await bot.send_message(admin_id, data)
 
+    # Получаем черновик отчета пользователя
+    current_remainings, current_sales = await get_draft(state)
 
-    with Session(autoflush=False, bind=engine) as db:
-
-        # Получаем id пользователя в telegram 
-        user_tg_id = message.from_user.id   
-         
-        # Получаем имя пользователя в telegram 
-        user_tg_name = message.from_user.username 
+    # Получаем id пользователя в telegram 
+    user_tg_id = message.from_user.id   
+     
+    # Получаем имя пользователя в telegram 
+    user_tg_name = message.from_user.username 
 
-        # Получаем объект пользователя
-        # Добавляем если пользователь отуствует в БД        
-        user = add_user(db, 
+    # Получаем объект пользователя
+    # Добавляем если пользователь отуствует в БД        
+    async with async_session() as db:
+        user = await add_user(db, 
                         tg_id = user_tg_id, 
                         name = user_tg_name
                         )
 
-        # Получаем текущую дату и время
-        current_datetime = datetime.now() 
+        # Магазин назначается в БД вне бота, и кэш других процессов об этом
+        # не узнает: для отчета магазин читаем заново, а не из кэша
+        store = await db.scalar(select(Users.store).where(Users.tg_id == user.tg_id))
+        if store != user.store:
+            user = user._replace(store=store)
+            users_cache.put(user)
+
+    # Получаем текущую дату и время
+    current_datetime = datetime.now() 
+    bucket = TimeRange.calculate_range(current_datetime).bucket
+
+    # Передаем отчет в очередь пакетной записи и ждем фиксации в БД
+    await report_writer.submit(dict(sales      =   current_sales, 
+                                    remainings =   current_remainings, 
+                                    user       =   user.tg_id,
+                                    username   =   user.name,
+                                    store      =   user.store,
+                                    date       =   current_datetime,
+                                    bucket     =   bucket,
+                                    ))
 
-        # Создаем объект таблицы отчета
-        report = Reports(sales      =   current_sales, 
-                         remainings =   current_remainings, 
-                         user       =   user.tg_id,
-                         username   =   user.name,
-                         store      =   user.store,
-                         date       =   current_datetime,
-                         )
-
-        # Добавляем созданный отчет в БД
-        db.add(report)
-        db.commit()
-
-        
-        print("Получен отчёт:" 
-              + "\nМагазин: " 
-              + str(user.store)
-              + "\nДата: " 
-              + str(current_datetime.strftime("%d.%m.%Y %H:%M"))
-              + "\nОстатки: " 
-              + str(current_remainings)
-              + "\nПродажи: " 
-              + str(current_sales)
-            )
-
-        await message.answer("Данные переданы!\n"
-                             + "➖➖➖➖➖➖\n"
-                             + "Остатки: " 
-                             + str(current_remainings) + " \n" 
-                             + "Продажи: " 
-                             + str(current_sales),
-                             reply_markup=main_keyboard()
-                             )        
-        
+    
+    report_submissions.inc(window=bucket)
+
+    logging.info("Получен отчёт: магазин %s, дата %s, остатки %s, продажи %s",
+                 user.store,
+                 current_datetime.strftime("%d.%m.%Y %H:%M"),
+                 current_remainings,
+                 current_sales
+                 )
+
+    await message.answer("Данные переданы!\n"
+                         + "➖➖➖➖➖➖\n"
+                         + "Остатки: " 
+                         + str(current_remainings) + " \n" 
+                         + "Продажи: " 
+                         + str(current_sales),
+                         reply_markup=main_keyboard()
+                         )        
+    
 
 # Обрабатываем сообщение "⏪ Вернуться назад"
 @dp.message(F.text == "⏪ Вернуться назад")
 async def reply_message(message: types.Message, state: FSMContext) -> None:
     await state.set_state(Form.default)
+    current_remainings, current_sales = await get_draft(state)
     await message.answer("Остатки: " 
                          + str(current_remainings)                         
                          + "\nПродажи: " 
@@ -250,14 +258,81 @@ async def main_menu(message: Message, state: FSMContext) -> None:
     pass  
 
 
+# Записываем отчеты из сообщения или файла одной транзакцией
+async def submit_bulk(message, state, text):
+
+    lines, errors = parse_bulk(text)
+
+    # Нет ни одной правильной строки: ждем исправленный отчет
+    if not lines:
+        await message.answer(bulk_summary(lines, errors), reply_markup=go_back_keyboard())
+        return
+
+    async with async_session() as db:
+        user = await add_user(db, 
+                        tg_id = message.from_user.id, 
+                        name = message.from_user.username
+                        )
+
+    current_datetime = datetime.now() 
+    bucket = TimeRange.calculate_range(current_datetime).bucket
+
+    await report_writer.submit_many([dict(sales      =   line.sales, 
+                                          remainings =   line.remainings, 
+                                          user       =   user.tg_id,
+                                          username   =   user.name,
+                                          store      =   line.store,
+                                          date       =   current_datetime,
+                                          bucket     =   bucket,
+                                          ) 
+                                     for line in lines
+                                     ])
+
+    report_submissions.inc(len(lines), window=bucket)
+
+    logging.info("Получены отчёты по %d магазинам от %s, ошибок в строках: %d",
+                 len(lines),
+                 user.name,
+                 len(errors)
+                 )
+
+    await state.set_state(Form.default)
+    await message.answer(bulk_summary(lines, errors), reply_markup=main_keyboard())
+
+
+# Обрабатываем CSV-файл с отчетами по магазинам
+@dp.message(Form.bulk, F.document)
+async def set_bulk_document(message: Message, state: FSMContext) -> None:
+    if message.document.file_size and message.document.file_size > MAX_DOCUMENT_BYTES:
+        await message.answer(f"Файл больше {MAX_DOCUMENT_BYTES // 1024} КБ, разделите отчёт на части", 
+                             reply_markup=go_back_keyboard()
+                             )
+        return
+
+    data = await message.bot.download(message.document)
+    text = decode_document(data.read())
+    if text is None:
+        await message.answer("Файл не является CSV: пришлите текстовый файл со строками "
+                             "магазин;остатки;продажи",
+                             reply_markup=go_back_keyboard()
+                             )
+        return
+
+    await submit_bulk(message, state, text)
+
+
+# Обрабатываем сообщение с отчетами по магазинам
+@dp.message(Form.bulk, F.text)
+async def set_bulk(message: Message, state: FSMContext) -> None:
+    await submit_bulk(message, state, message.text)
+
+
 # Обрабатываем состояние "Остатки"
 @dp.message(Form.remainings)
-async def set_balance(message: Message, state: FSMContext) -> None:
+async def set_remainings(message: Message, state: FSMContext) -> None:
     remainings_value = message.text    
     if remainings_value.isdigit():
-        await state.update_data(remainings = message.text)   
-        global current_remainings
-        current_remainings = int(remainings_value)  
+        await state.update_data(remainings = int(remainings_value))   
         await message.answer("Укажите текущие продажи:", 
                              reply_markup=go_back_keyboard()
                              )                   
@@ -270,12 +345,11 @@ async def set_balance(message: Message, state: FSMContext) -> None:
 
 # Обрабатываем состояние "Продажи"
 @dp.message(Form.sales)
-async def set_balance(message: Message, state: FSMContext) -> None:
+async def set_sales(message: Message, state: FSMContext) -> None:
     sales_value = message.text    
     if sales_value.isdigit():
-        await state.update_data(sales = message.text)  
-        global current_sales
-        current_sales = int(sales_value)  
+        await state.update_data(sales = int(sales_value))  
+        current_remainings, current_sales = await get_draft(state)
         await message.answer("Остатки: " + str(current_remainings)                              
                              + "\nПродажи: " 
                              + str(current_sales), 
@@ -288,8 +362,40 @@ async def set_balance(message: Message, state: FSMContext) -> None:
                              ) 
 
 
+# Обновляем схему БД и запускаем запись метрик процесса при старте
+@dp.startup()
+async def on_startup() -> None:
+    await migrate_database()
+    start_publishing(config.metrics_flush_interval)
+
+
+# Дописываем отчеты и сообщения из очередей и закрываем соединения с БД при остановке
+@dp.shutdown()
+async def on_shutdown() -> None:
+    await report_writer.close()
+    await outgoing.close()
+    await stop_publishing()
+    await dispose_engine()
+
+
 # Запуск процесса поллинга новых апдейтов
 async def main():
+
+    # В режиме вебхука апдейты принимает веб-процесс (web.py), а процесс
+    # поллинга не нужен (на Heroku: heroku ps:scale worker=0). Если он все же
+    # запущен, ждем остановки: при выходе Heroku перезапускал бы его по кругу
+    if config.bot_mode == "webhook":
+        logging.warning("Включен режим вебхука, поллинг не запускается: "
+                        "апдейты принимает web.py, этот процесс можно остановить")
+        await asyncio.Event().wait()
+
+    # Апдейты раздаются рабочим процессам по чатам
+    if config.workers > 1:
+        from sharding import run_front
+        await run_front("sales", config.workers)
+        return
+
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 # Стартуем!
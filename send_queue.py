@@ -0,0 +1,242 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from metrics import Counter, Histogram
+
+
+#
+# Очередь исходящих сообщений с ограничением скорости и приоритетами
+#
+# Все запросы бота, адресованные чату (ответы обработчиков, документы,
+# рассылки итогов смены), проходят через одну очередь: они отправляются
+# не чаще rate в секунду на бота и не чаще раза в chat_interval секунд
+# в один чат (после короткого всплеска из chat_burst сообщений).
+# Ответы обработчиков (INTERACTIVE) обгоняют рассылки (BULK).
+# На TelegramRetryAfter очередь приостанавливает отправку на указанное время,
+# на сетевые ошибки и ошибки сервера повторяет запрос с растущей паузой.
+#
+
+logger = logging.getLogger(__name__)
+
+# Ограничения Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в один чат
+SEND_RATE = 25
+CHAT_INTERVAL = 1.0
+# Сколько сообщений подряд можно отправить в чат без паузы
+CHAT_BURST = 3
+# Сколько раз повторяем запрос после TelegramRetryAfter или сетевой ошибки
+MAX_RETRIES = 3
+# Пауза перед первым повтором после сетевой ошибки, с (дальше удваивается)
+BACKOFF = 0.5
+
+# Приоритеты: меньше - раньше
+INTERACTIVE = 0
+BULK = 1
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+sent_messages = Counter("send_queue_messages_total", "Сообщения из очереди рассылки", ("result",))
+queue_wait_seconds = Histogram("send_queue_wait_seconds", "Ожидание в очереди отправки", ("priority",))
+
+# Запрос выполняется задачей очереди: промежуточный слой пропускает его без очереди
+_in_queue = contextvars.ContextVar("send_queue_delivery", default=False)
+
+
+# Запрос в очереди
+class Delivery:
+
+    __slots__ = ("chat_id", "request", "future", "queued", "attempt")
+
+    def __init__(self, chat_id, request, future, queued):
+        self.chat_id = chat_id
+        self.request = request
+        self.future = future
+        self.queued = queued
+        self.attempt = 0
+
+
+class SendQueue:
+
+    def __init__(self, bot, rate=SEND_RATE, chat_interval=CHAT_INTERVAL, chat_burst=CHAT_BURST,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+
+        self.bot = bot
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        # Насколько расчетное время следующего сообщения в чат может опережать текущее
+        self.chat_tolerance = (chat_burst - 1) * chat_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._queue = None
+        self._task = None
+        self._order = itertools.count()
+        self._next_send = 0.0
+        # Чат -> расчетное время следующего сообщения
+        self._chat_next = {}
+        # Задачи отправки и отложенных сообщений
+        self._pending = set()
+
+    def __len__(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    # Запускаем фоновую задачу отправки
+    def start(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.PriorityQueue()
+            self._task = asyncio.create_task(self._run())
+
+    # Ставим запрос request() к чату в очередь
+    def submit(self, chat_id, request, priority=BULK, future=None):
+        self.start()
+        self._queue.put_nowait((priority, next(self._order), Delivery(chat_id, request, future, self.clock())))
+
+    # Ставим сообщение в очередь, не дожидаясь отправки
+    def put(self, chat_id, text, priority=BULK, **kwargs):
+        self.submit(chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs), priority)
+
+    # Выполняем запрос в порядке очереди и возвращаем его результат
+    async def call(self, chat_id, request, priority=INTERACTIVE):
+        future = asyncio.get_running_loop().create_future()
+        self.submit(chat_id, request, priority, future)
+        return await future
+
+    # Ждем отправки всех сообщений из очереди (вместе с повторами)
+    async def join(self):
+        if self._queue is None:
+            return
+        while True:
+            await self._queue.join()
+            if not self._pending:
+                return
+            await asyncio.wait(set(self._pending))
+
+    # Отправляем оставшиеся сообщения и останавливаем задачу
+    async def close(self):
+        if self._task is None:
+            return
+        await self.join()
+        await self._queue.put((float("inf"), next(self._order), None))
+        await self._task
+        self._task = None
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    # Возвращаем сообщение в очередь через delay секунд, сохраняя его место
+    async def _requeue(self, priority, order, delivery, delay):
+        if delay > 0:
+            await self.sleep(delay)
+        self._queue.put_nowait((priority, order, delivery))
+
+    async def _run(self):
+
+        # Запросы из задач очереди идут в Telegram напрямую
+        _in_queue.set(True)
+
+        while True:
+            priority, order, delivery = await self._queue.get()
+            try:
+                if delivery is None:
+                    return
+
+                now = self.clock()
+                if self._next_send > now:
+                    await self.sleep(self._next_send - now)
+                    now = self.clock()
+
+                # Чат исчерпал всплеск: откладываем сообщение, не задерживая другие чаты
+                chat_next = self._chat_next.get(delivery.chat_id, 0.0)
+                if chat_next - self.chat_tolerance > now:
+                    self._spawn(self._requeue(priority, order, delivery, chat_next - self.chat_tolerance - now))
+                    continue
+
+                self._next_send = now + self.interval
+                self._chat_next[delivery.chat_id] = max(chat_next, now) + self.chat_interval
+
+                # Не храним чаты, в которые уже можно писать без ограничений
+                if len(self._chat_next) > 1000:
+                    self._chat_next = {chat: ready for chat, ready in self._chat_next.items() if ready > now}
+
+                if delivery.attempt == 0:
+                    queue_wait_seconds.observe(now - delivery.queued, priority=PRIORITY_NAMES.get(priority, priority))
+                self._spawn(self._deliver(priority, order, delivery))
+            except Exception:
+                logger.exception("Ошибка очереди рассылки")
+            finally:
+                self._queue.task_done()
+
+    # Выполняем запрос, при ошибках Telegram и сети повторяем
+    async def _deliver(self, priority, order, delivery):
+
+        try:
+            result = await delivery.request()
+        except TelegramRetryAfter as error:
+            if delivery.attempt < MAX_RETRIES:
+                logger.warning("Превышен лимит Telegram, повтор через %s с", error.retry_after)
+                self._next_send = max(self._next_send, self.clock() + error.retry_after)
+                self._retry(priority, order, delivery, 0)
+                return
+            logger.error("Не удалось отправить сообщение в чат %s: лимит Telegram", delivery.chat_id)
+            self._fail(delivery, error)
+        except (TelegramNetworkError, TelegramServerError) as error:
+            if delivery.attempt < MAX_RETRIES:
+                delay = BACKOFF * 2 ** delivery.attempt
+                logger.warning("Ошибка отправки в чат %s, повтор через %s с: %s", delivery.chat_id, delay, error)
+                self._retry(priority, order, delivery, delay)
+                return
+            logger.exception("Не удалось отправить сообщение в чат %s", delivery.chat_id)
+            self._fail(delivery, error)
+        except Exception as error:
+            # Ответ обработчику передает ошибку вызывающему, рассылка только пишет в лог
+            if delivery.future is None:
+                logger.exception("Не удалось отправить сообщение в чат %s", delivery.chat_id)
+            self._fail(delivery, error)
+        else:
+            self.sent += 1
+            sent_messages.inc(result="sent")
+            if delivery.future is not None and not delivery.future.done():
+                delivery.future.set_result(result)
+
+    def _retry(self, priority, order, delivery, delay):
+        delivery.attempt += 1
+        self.retried += 1
+        sent_messages.inc(result="retried")
+        self._spawn(self._requeue(priority, order, delivery, delay))
+
+    def _fail(self, delivery, error):
+        self.failed += 1
+        sent_messages.inc(result="failed")
+        if delivery.future is not None and not delivery.future.done():
+            delivery.future.set_exception(error)
+
+
+# Промежуточный слой сессии бота: запросы к чатам (message.answer и т.п.)
+# отправляются через очередь с приоритетом INTERACTIVE
+class SendQueueMiddleware(BaseRequestMiddleware):
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    async def __call__(self, make_request, bot, method):
+
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or _in_queue.get():
+            return await make_request(bot, method)
+
+        return await self.queue.call(chat_id, lambda: make_request(bot, method))
+
+
+# Создаем очередь бота и направляем через нее все его запросы к чатам
+def setup_send_queue(bot, **kwargs):
+    queue = SendQueue(bot, **kwargs)
+    bot.session.middleware(SendQueueMiddleware(queue))
+    return queue
@@ -0,0 +1,404 @@
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import os
+import sys
+
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError
+
+
+#
+# Обработка апдейтов бота несколькими процессами
+#
+# Передний процесс получает апдейты (поллинг, или вебхук в web.py) и раздает их
+# WORKERS рабочим процессам по номеру чата. Чат закреплен за одним процессом,
+# поэтому его апдейты обрабатываются по порядку, а состояния FSM, которые
+# DatabaseStorage держит в памяти процесса, остаются актуальными.
+#
+# Чаты разбиты на SLOTS групп, группа slot принадлежит процессу slot % WORKERS.
+# Если процесс завершился, его группы временно переходят к остальным,
+# а апдейты, обработку которых он не подтвердил, отправляются новым владельцам.
+# Перезапущенному процессу группы возвращаются: передний процесс придерживает
+# новые апдейты этих чатов, временный владелец дорабатывает начатые, записывает
+# состояния FSM в БД и забывает их, после чего придержанные апдейты уходят
+# вернувшемуся процессу.
+#
+# Процессы связаны через TCP на 127.0.0.1, сообщения - строки JSON:
+#   передний -> рабочий: {"id", "update"}, {"release": [группы]}, {"stop": true}
+#   рабочий -> передний: {"hello": номер}, {"done": id}, {"released": [группы]}
+#
+# Запуск: WORKERS=4 python sales.py (или results.py), рабочие процессы
+# передний процесс запускает сам: python sharding.py sales <номер> <порт> <процессов>
+#
+
+logger = logging.getLogger(__name__)
+
+# Количество групп чатов
+SLOTS = 64
+# Пауза перед перезапуском завершившегося рабочего процесса, с
+RESTART_DELAY = 1.0
+# Наибольшая длина строки протокола, байт
+LINE_LIMIT = 1024 * 1024
+# Ожидание getUpdates на стороне Telegram и пауза после ошибки поллинга, с
+POLLING_TIMEOUT = 30
+POLLING_BACKOFF = 5.0
+
+
+# Чат апдейта (в виде словаря из JSON): чат события, чат сообщения
+# под кнопкой или, если чата нет, пользователь
+def chat_of(update):
+
+    event = next((value for key, value in update.items() if key != "update_id" and isinstance(value, dict)), {})
+    chat = event.get("chat") or (event.get("message") or {}).get("chat")
+    if chat is not None:
+        return chat["id"]
+
+    return (event.get("from") or {}).get("id", 0)
+
+
+def slot_of(chat_id):
+    return chat_id % SLOTS
+
+
+def encode(message):
+    return (json.dumps(message, ensure_ascii=False) + "\n").encode()
+
+
+# Соединение с рабочим процессом
+class Link:
+
+    def __init__(self, writer):
+        self.writer = writer
+        # id -> (группа, апдейт), обработка которых еще не подтверждена
+        self.pending = {}
+
+    # Пока потеря соединения не обработана, сообщения ему не пишем:
+    # неподтвержденные апдейты все равно будут отправлены заново
+    def write(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(encode(message))
+
+
+# Передний процесс: запускает рабочие процессы и раздает им апдейты
+class ShardFront:
+
+    def __init__(self, name, workers, command=None, restart_delay=RESTART_DELAY):
+
+        self.name = name
+        self.workers = workers
+        self.command = command or self.worker_command
+        self.restart_delay = restart_delay
+        self.dispatched = 0
+        self.processed = 0
+        self.resent = 0
+        self.returned = 0
+        # Группа -> номер процесса-владельца
+        self.owners = [slot % workers for slot in range(SLOTS)]
+        self.links = {}
+        self.processes = {}
+        # Группы, которые передаются: группа -> номер получателя и придержанные апдейты
+        self.moving = {}
+        self.held = {}
+        self._order = itertools.count()
+        self._server = None
+        self._supervisors = []
+        self._connections = set()
+        self._ready = None
+        self._idle = None
+        self._closing = False
+
+    # Команда запуска рабочего процесса
+    def worker_command(self, index, port):
+        return [sys.executable, os.path.abspath(__file__), self.name, str(index), str(port), str(self.workers)]
+
+    # Запускаем рабочие процессы и ждем их подключения
+    async def start(self):
+
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._server = await asyncio.start_server(self._connected, "127.0.0.1", 0, limit=LINE_LIMIT)
+        port = self._server.sockets[0].getsockname()[1]
+        self._supervisors = [asyncio.create_task(self._supervise(index, port)) for index in range(self.workers)]
+        await self._ready.wait()
+        logger.info("Запущено рабочих процессов бота %s: %d", self.name, self.workers)
+
+    # Передаем апдейт (словарь из JSON) процессу, за которым закреплен его чат
+    def dispatch(self, update):
+        self._route(slot_of(chat_of(update)), update)
+
+    # Ждем, пока рабочие процессы обработают все переданные апдейты
+    async def join(self):
+        await self._idle.wait()
+
+    # Дожидаемся обработки, останавливаем рабочие процессы
+    async def close(self):
+
+        await self.join()
+        self._closing = True
+        for link in self.links.values():
+            link.write({"stop": True})
+        await asyncio.gather(*self._supervisors, return_exceptions=True)
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _route(self, slot, update):
+        if slot in self.held:
+            self.held[slot].append(update)
+            self._idle.clear()
+            return
+        self._send(self.owners[slot], slot, update)
+
+    def _send(self, index, slot, update):
+        link = self.links[index]
+        number = next(self._order)
+        link.pending[number] = (slot, update)
+        link.write({"id": number, "update": update})
+        self.dispatched += 1
+        self._idle.clear()
+
+    def _check_idle(self):
+        if self.dispatched == self.processed and not self.held:
+            self._idle.set()
+
+    # Запускаем рабочий процесс и перезапускаем его, если он завершился
+    async def _supervise(self, index, port):
+
+        while True:
+            process = await asyncio.create_subprocess_exec(*self.command(index, port))
+            self.processes[index] = process
+            code = await process.wait()
+            if self._closing:
+                return
+            logger.error("Рабочий процесс %d бота %s завершился с кодом %s, перезапуск", index, self.name, code)
+            await asyncio.sleep(self.restart_delay)
+            if self._closing:
+                return
+
+    async def _connected(self, reader, writer):
+
+        task = asyncio.current_task()
+        self._connections.add(task)
+        index = None
+        try:
+            hello = json.loads(await reader.readline())
+            index = hello["hello"]
+            self.links[index] = Link(writer)
+
+            # Процесс перезапустился, когда остальные уже останавливаются
+            if self._closing:
+                self.links[index].write({"stop": True})
+            else:
+                self._adopt(index)
+                self._return_slots(index)
+            if len(self.links) == self.workers:
+                self._ready.set()
+
+            while line := await reader.readline():
+                message = json.loads(line)
+                if "done" in message:
+                    if self.links[index].pending.pop(message["done"], None) is not None:
+                        self.processed += 1
+                        self._check_idle()
+                elif "released" in message:
+                    self._released(message["released"])
+        except ConnectionError:
+            logger.warning("Разорвано соединение с рабочим процессом %s", index)
+        except (json.JSONDecodeError, KeyError):
+            logger.exception("Ошибка связи с рабочим процессом %s", index)
+        finally:
+            writer.close()
+            if index is not None:
+                self._lost(index)
+            self._connections.discard(task)
+
+    # Подключившийся процесс забирает группы, апдейты которых придержаны без владельца
+    def _adopt(self, index):
+
+        for slot in [slot for slot in self.held if slot not in self.moving and self.owners[slot] not in self.links]:
+            self.owners[slot] = index
+            for update in self.held.pop(slot):
+                self._send(index, slot, update)
+
+        self._check_idle()
+
+    # Процесс перезапущен: забираем его группы у временных владельцев
+    def _return_slots(self, index):
+
+        owners = {}
+        for slot in range(SLOTS):
+            if slot % self.workers == index and self.owners[slot] in self.links and self.owners[slot] != index \
+                    and slot not in self.moving:
+                owners.setdefault(self.owners[slot], []).append(slot)
+
+        for owner, slots in owners.items():
+            for slot in slots:
+                self.moving[slot] = index
+                self.held.setdefault(slot, [])
+            self.links[owner].write({"release": slots})
+            logger.info("Групп чатов возвращается процессу %d: %d", index, len(slots))
+
+    # Временный владелец освободил группы: отдаем их вместе с придержанными апдейтами
+    def _released(self, slots):
+
+        for slot in slots:
+            target = self.moving.pop(slot, None)
+            if target is not None and target in self.links:
+                self.owners[slot] = target
+                self.returned += 1
+            updates = self.held.pop(slot, [])
+            if updates and self.owners[slot] not in self.links:
+                # Получателя уже нет: придерживаем до следующего перезапуска
+                self.held[slot] = updates
+                continue
+            for update in updates:
+                self._send(self.owners[slot], slot, update)
+
+        self._check_idle()
+
+    # Процесс завершился: отдаем его группы остальным и повторяем неподтвержденные апдейты
+    def _lost(self, index):
+
+        link = self.links.pop(index, None)
+        if link is None:
+            return
+
+        self.dispatched -= len(link.pending)
+        pending = [item for _, item in sorted(link.pending.items())]
+
+        if self._closing:
+            self._check_idle()
+            return
+
+        slots = [slot for slot, owner in enumerate(self.owners) if owner == index]
+
+        # Группы, которые процесс отдавал: передача завершена, его неподтвержденные
+        # апдейты ставим перед придержанными
+        releasing = [slot for slot in slots if slot in self.moving]
+        for slot in releasing:
+            self.held[slot] = [update for update_slot, update in pending if update_slot == slot] + self.held[slot]
+
+        # Остальные группы раздаем оставшимся процессам, если их нет - придерживаем апдейты
+        live = sorted(self.links)
+        for number, slot in enumerate(slot for slot in slots if slot not in self.moving):
+            if live:
+                self.owners[slot] = live[number % len(live)]
+            else:
+                self.held.setdefault(slot, [])
+
+        resend = [(slot, update) for slot, update in pending if slot not in releasing]
+        self.resent += len(resend)
+        for slot, update in resend:
+            self._route(slot, update)
+
+        self._released(releasing)
+
+
+# Рабочий процесс: обрабатывает апдейты своих чатов, апдейты одного чата - по порядку
+async def run_worker(name, index, port, workers, bot=None):
+
+    from config_reader import config
+
+    module = importlib.import_module(name)
+    dp = module.dp
+    bot = bot or module.bot
+
+    # Итоги смены рассылает только первый процесс
+    if index > 0:
+        config.shift_digest = False
+
+    # Лимит отправки в Telegram общий на бота: делим его между процессами
+    outgoing = getattr(module, "outgoing", None)
+    if outgoing is not None:
+        outgoing.interval *= workers
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=LINE_LIMIT)
+    await dp.emit_startup(bot=bot, bots=[bot], dispatcher=dp)
+
+    # Чат -> задача его последнего апдейта
+    tails = {}
+
+    async def handle(previous, number, update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception:
+            logger.exception("Ошибка обработки апдейта %s", update.get("update_id"))
+        writer.write(encode({"done": number}))
+
+    async def release(slots):
+        await asyncio.gather(*[task for chat, task in list(tails.items()) if slot_of(chat) in slots])
+        storage_release = getattr(dp.storage, "release", None)
+        if storage_release is not None:
+            await storage_release(lambda chat: slot_of(chat) in slots)
+        writer.write(encode({"released": sorted(slots)}))
+
+    def forget(chat, task):
+        if tails.get(chat) is task:
+            del tails[chat]
+
+    writer.write(encode({"hello": index}))
+    releases = []
+
+    try:
+        while line := await reader.readline():
+            message = json.loads(line)
+
+            if "update" in message:
+                chat = chat_of(message["update"])
+                task = asyncio.create_task(handle(tails.get(chat), message["id"], message["update"]))
+                tails[chat] = task
+                task.add_done_callback(lambda task, chat=chat: forget(chat, task))
+            elif "release" in message:
+                releases.append(asyncio.create_task(release(set(message["release"]))))
+            elif "stop" in message:
+                break
+
+            await writer.drain()
+
+        await asyncio.gather(*tails.values(), *releases)
+        await writer.drain()
+    finally:
+        await dp.emit_shutdown(bot=bot, bots=[bot], dispatcher=dp)
+        writer.close()
+
+
+# Поллинг в переднем процессе: апдейты раздаются рабочим процессам
+async def run_front(name, workers):
+
+    from migrations import migrate_database
+
+    module = importlib.import_module(name)
+    bot = module.bot
+    allowed_updates = module.dp.resolve_used_update_types()
+
+    await migrate_database()
+    front = ShardFront(name, workers)
+    await front.start()
+
+    try:
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates)
+            except (TelegramNetworkError, TelegramAPIError):
+                logger.exception("Ошибка получения апдейтов, повтор через %s с", POLLING_BACKOFF)
+                await asyncio.sleep(POLLING_BACKOFF)
+                continue
+
+            for update in updates:
+                front.dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+    finally:
+        await front.close()
+        await bot.session.close()
+
+
+# Рабочий процесс: python sharding.py <бот> <номер> <порт> <процессов>
+if __name__ == "__main__":
+    name, index, port, workers = sys.argv[1], *map(int, sys.argv[2:5])
+    asyncio.run(run_worker(name, index, port, workers))
@@ -0,0 +1,133 @@
+from abc import ABC, abstractmethod
+from db_store import Users
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+#
+# Хранилище: различия SQLite и PostgreSQL
+#
+# Движки (database.py), запись пользователей и отчетов и перенос данных
+# между БД (copy_database.py) обращаются к хранилищу своего диалекта.
+# SQLite - один файл и один пишущий процесс, соединения настраиваются
+# через PRAGMA. PostgreSQL - пул соединений asyncpg, запись из нескольких
+# процессов одновременно, массовая загрузка через COPY.
+# Проверка обоих хранилищ одними и теми же прогонами:
+# python benchmark.py storage (см. benchmark.py)
+#
+
+# Настройки SQLite для каждого нового соединения
+SQLITE_PRAGMAS = {
+    # В режиме WAL достаточно синхронизации при контрольной точке
+    "synchronous": "NORMAL",
+    # Ждем освобождения блокировки вместо ошибки "database is locked"
+    "busy_timeout": 5000,
+    # Кэш страниц ~20 МБ на соединение
+    "cache_size": -20000,
+    "temp_store": "MEMORY",
+}
+
+
+class Storage(ABC):
+
+    # Имя диалекта SQLAlchemy
+    dialect = None
+
+    # INSERT с поддержкой ON CONFLICT
+    @abstractmethod
+    def insert(self, table):
+        pass
+
+    # Параметры драйвера для соединений нового движка
+    def connect_args(self, read_only=False):
+        return {}
+
+    # Настраиваем новый движок
+    def configure(self, engine, journal_mode=None, read_only=False):
+        pass
+
+    # Добавляем пользователя, если его еще нет, и возвращаем tg_id, name и store
+    async def add_user(self, db, tg_id, name):
+
+        await db.execute(self.insert(Users)
+                         .values(tg_id=tg_id, name=name)
+                         .on_conflict_do_nothing(index_elements=[Users.tg_id])
+                         )
+
+        return (await db.execute(select(Users.tg_id, Users.name, Users.store)
+                                 .where(Users.tg_id==tg_id)
+                                 )).one()
+
+    # Загружаем строки (кортежи в порядке columns) в таблицу (асинхронное соединение)
+    async def copy_rows(self, conn, table, columns, rows):
+        await conn.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+
+    # Продолжаем нумерацию первичного ключа после загруженных строк
+    async def reset_sequence(self, conn, table):
+        pass
+
+
+class SqliteStorage(Storage):
+
+    dialect = "sqlite"
+
+    def insert(self, table):
+        return sqlite.insert(table)
+
+    # journal_mode сохраняется в файле БД, поэтому его задает только пишущий движок,
+    # а соединения только для чтения переводятся в query_only
+    def configure(self, engine, journal_mode=None, read_only=False):
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            if journal_mode:
+                cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            for name, value in SQLITE_PRAGMAS.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            if read_only:
+                cursor.execute("PRAGMA query_only=ON")
+            cursor.close()
+
+
+class PostgresStorage(Storage):
+
+    dialect = "postgresql"
+
+    def insert(self, table):
+        return postgresql.insert(table)
+
+    # Соединения только для чтения не могут изменить данные по ошибке
+    def connect_args(self, read_only=False):
+        if read_only:
+            return {"server_settings": {"default_transaction_read_only": "on"}}
+        return {}
+
+    # COPY в транзакции соединения: она начинается с первого запроса через SQLAlchemy
+    async def copy_rows(self, conn, table, columns, rows):
+        connection = await conn.get_raw_connection()
+        await connection.driver_connection.copy_records_to_table(table.name, records=rows, columns=columns)
+
+    # После загрузки строк с готовыми номерами последовательность SERIAL
+    # все еще начинается с 1
+    async def reset_sequence(self, conn, table):
+
+        column = table.autoincrement_column
+        if column is None:
+            return
+
+        await conn.execute(select(func.setval(func.pg_get_serial_sequence(table.name, column.name),
+                                              func.coalesce(func.max(column), 0) + 1,
+                                              False
+                                              )))
+
+
+STORAGES = {storage.dialect: storage for storage in (SqliteStorage(), PostgresStorage())}
+
+
+# Хранилище по имени диалекта
+def storage_for(dialect):
+    storage = STORAGES.get(dialect)
+    if storage is None:
+        raise ValueError(f"БД {dialect} не поддерживается, доступны: {', '.join(STORAGES)}")
+    return storage
@@ -0,0 +1,95 @@
+from database import dialect_insert
+from db_store import SUBMISSION_KEY, Reports, report_revisions
+from sqlalchemy import insert, select
+from window_totals import apply_totals
+
+
+#
+# Запись отчетов: одна строка на пользователя, магазин и смену
+#
+# Повторное нажатие "Передать данные" или исправление в ту же смену
+# обновляет отчет (INSERT ... ON CONFLICT DO UPDATE по ux_reports_submission),
+# прежние значения при желании сохраняются в report_revisions.
+# Накопительные суммы меняются на разницу между новым и прежним отчетом.
+#
+
+# Таблица отчетов
+reports = Reports.__table__
+
+
+# Ключ отчета в том же виде, что и уникальный индекс
+def submission_key(user, store, bucket):
+    return user, store or '', bucket
+
+
+# Повторные отчеты внутри пакета: остается последний.
+# Отчеты без пользователя (не из бота) ключа не имеют и не объединяются
+def latest_submissions(values):
+    latest = {}
+    for number, item in enumerate(values):
+        if item['user'] is None:
+            latest[number] = item
+        else:
+            latest[submission_key(item['user'], item['store'], item['bucket'])] = item
+    return list(latest.values())
+
+
+# Уже записанные отчеты с теми же ключами
+async def previous_reports(db, values):
+
+    keyed = [item for item in values if item['user'] is not None]
+    if not keyed:
+        return {}
+
+    rows = await db.execute(select(reports.c.reports_id,
+                                   reports.c.user,
+                                   reports.c.store,
+                                   reports.c.bucket,
+                                   reports.c.sales,
+                                   reports.c.remainings,
+                                   reports.c.date
+                                   )
+                            .where(reports.c.user.in_({item['user'] for item in keyed}),
+                                   reports.c.bucket.in_({item['bucket'] for item in keyed})
+                                   ))
+
+    return {submission_key(row.user, row.store, row.bucket): row for row in rows}
+
+
+# Записываем пакет отчетов (в транзакции ReportWriter)
+async def save_reports(db, values, revisions=None):
+
+    if revisions is None:
+        from config_reader import config
+        revisions = config.report_revisions
+
+    values = latest_submissions(values)
+    previous = await previous_reports(db, values)
+
+    query = dialect_insert(db, reports)
+    query = query.on_conflict_do_update(index_elements=list(SUBMISSION_KEY),
+                                        set_=dict(sales=query.excluded.sales,
+                                                  remainings=query.excluded.remainings,
+                                                  username=query.excluded.username,
+                                                  date=query.excluded.date,
+                                                  ))
+    await db.execute(query, values)
+
+    # Изменения сумм: новый отчет добавляется целиком, исправленный - разницей
+    changes = []
+    replaced = []
+    for item in values:
+        old = previous.get(submission_key(item['user'], item['store'], item['bucket'])) if item['user'] is not None else None
+        if old is None:
+            changes.append((item['date'], item['store'], item['sales'] or 0, item['remainings'] or 0, 1))
+        else:
+            changes.append((item['date'], item['store'],
+                            (item['sales'] or 0) - (old.sales or 0),
+                            (item['remainings'] or 0) - (old.remainings or 0),
+                            0))
+            replaced.append(dict(reports_id=old.reports_id, sales=old.sales, remainings=old.remainings, date=old.date))
+
+    await apply_totals(db, changes)
+
+    if revisions and replaced:
+        await db.execute(insert(report_revisions), replaced)
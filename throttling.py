@@ -0,0 +1,89 @@
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+from metrics import Counter
+
+
+#
+# Защита от повторных нажатий
+#
+# Одинаковые апдейты одного пользователя в одном чате и состоянии FSM
+# (например, несколько нажатий "Передать данные" или "Суммы сейчас" подряд)
+# обрабатываются один раз: повтор отбрасывается, если обработка первого
+# еще идет или с его поступления прошло меньше interval секунд.
+#
+
+logger = logging.getLogger(__name__)
+
+# Интервал, в течение которого одинаковое нажатие считается повтором, с
+THROTTLE_INTERVAL = 1.0
+
+throttled_updates = Counter("throttled_updates_total", "Отброшенные повторные апдейты", ("bot",))
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+
+    def __init__(self, bot_name, interval=THROTTLE_INTERVAL, clock=time.monotonic):
+
+        self.bot_name = bot_name
+        self.interval = interval
+        self.clock = clock
+        # Ключ апдейта -> время поступления
+        self._seen = {}
+        # Ключи апдейтов, которые сейчас обрабатываются
+        self._running = set()
+
+    # Ключ апдейта: чат, пользователь, состояние FSM и текст или данные кнопки.
+    # У сообщений без текста вместо него - файл документа или номер сообщения:
+    # файлы, отправленные вместе, приходят отдельными сообщениями подряд
+    async def key(self, event, data):
+
+        state = data.get("state")
+        state = await state.get_state() if state is not None else None
+
+        if isinstance(event, CallbackQuery):
+            chat_id = event.message.chat.id if event.message else None
+            return chat_id, event.from_user.id, state, "callback", event.data
+
+        if event.text is not None:
+            content = event.text
+        elif event.document is not None:
+            content = event.document.file_unique_id
+        else:
+            content = event.message_id
+
+        return event.chat.id, event.from_user.id if event.from_user else None, state, "message", content
+
+    async def __call__(self, handler, event, data):
+
+        key = await self.key(event, data)
+        now = self.clock()
+
+        if key in self._running or now - self._seen.get(key, float("-inf")) < self.interval:
+            throttled_updates.inc(bot=self.bot_name)
+            logger.info("Повторный апдейт отброшен: чат %s", key[0])
+            # Убираем часики на кнопке
+            if isinstance(event, CallbackQuery):
+                await event.answer()
+            return None
+
+        self._seen[key] = now
+        # Не храним ключи, повтор которых уже не отбрасывается
+        if len(self._seen) > 10000:
+            self._seen = {seen: at for seen, at in self._seen.items() if now - at < self.interval}
+
+        self._running.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._running.discard(key)
+
+
+# Подключаем защиту от повторов к сообщениям и кнопкам диспетчера
+def setup_throttling(dp, bot_name, interval=THROTTLE_INTERVAL):
+    middleware = ThrottlingMiddleware(bot_name, interval)
+    dp.message.outer_middleware(middleware)
+    dp.callback_query.outer_middleware(middleware)
+    return middleware
@@ -0,0 +1,68 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+
+#
+# Диапазон времени (смена) на основании текущего времени и графика смен
+#
+# График задается в настройках (SHIFT_HOURS) часами начала смен,
+# по умолчанию [0, 12, 18]: с 00:00 до 12:00, с 12:00 до 18:00 и с 18:00 до 00:00.
+#
+
+# Количество смен в сутках, под которое рассчитан номер диапазона (bucket)
+MAX_SHIFTS = 100
+
+# Через сколько после окончания диапазона он считается закрытым
+# (с запасом на отчеты, ожидающие пакетной записи)
+WINDOW_CLOSE_DELAY = timedelta(minutes=1)
+
+
+# Часы начала смен из настроек
+def shift_hours():
+    from config_reader import config
+    return config.shift_hours
+
+
+class TimeRange:
+
+
+    def __init__(self, start, end, range, bucket=None):
+
+        self.start = start
+        self.end = end
+        self.range = range
+        # Номер диапазона: дата и номер смены, например 2025061101
+        self.bucket = bucket
+
+    # Номер диапазона для даты и номера смены
+    @staticmethod
+    def make_bucket(date, index):
+        return (date.year * 10000 + date.month * 100 + date.day) * MAX_SHIFTS + index
+
+    @staticmethod
+    def calculate_range(date, hours = None):
+
+        hours   = hours or shift_hours()
+        index   = bisect_right(hours, date.hour) - 1
+        day     = datetime(date.year, date.month, date.day)
+
+        start   = day + timedelta(hours=hours[index])
+
+        if index + 1 < len(hours):
+            end_hour = hours[index + 1]
+        else:
+            end_hour = 24
+
+        end     = day + timedelta(hours=end_hour) - timedelta(microseconds=1)
+        range   = f"{index + 1}. С {hours[index]:02}:00 до {end_hour % 24:02}:00"
+
+        return TimeRange(start, end, range, TimeRange.make_bucket(date, index))
+
+    # Диапазон по его номеру
+    @staticmethod
+    def from_bucket(bucket, hours = None):
+
+        hours   = hours or shift_hours()
+        day     = datetime.strptime(str(bucket // MAX_SHIFTS), "%Y%m%d")
+
+        return TimeRange.calculate_range(day + timedelta(hours=hours[bucket % MAX_SHIFTS]), hours)
@@ -0,0 +1,75 @@
+import time
+
+from collections import OrderedDict
+from metrics import cache_requests
+from typing import NamedTuple, Optional
+
+
+#
+# Кэш пользователей в памяти процесса
+#
+
+# Снимок записи пользователя, который безопасно хранить между сессиями БД
+class CachedUser(NamedTuple):
+    tg_id: int
+    name: Optional[str]
+    store: Optional[str]
+
+
+# Ограниченный по размеру LRU-кэш со временем жизни записей
+class UserCache:
+
+    def __init__(self, maxsize=10000, ttl=300, clock=time.monotonic, name="users"):
+
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, tg_id):
+
+        item = self._items.get(tg_id)
+
+        # Запись отсутствует или устарела
+        if item is None or item[1] < self.clock():
+            if item is not None:
+                del self._items[tg_id]
+            self.misses += 1
+            cache_requests.inc(cache=self.name, result="miss")
+            return None
+
+        # Свежая запись поднимается в конец очереди вытеснения
+        self._items.move_to_end(tg_id)
+        self.hits += 1
+        cache_requests.inc(cache=self.name, result="hit")
+        return item[0]
+
+    def put(self, user):
+
+        self._items[user.tg_id] = (user, self.clock() + self.ttl)
+        self._items.move_to_end(user.tg_id)
+
+        # Вытесняем давно не использованные записи
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def invalidate(self, tg_id):
+        self._items.pop(tg_id, None)
+
+    def clear(self):
+        self._items.clear()
+
+    # Счетчики попаданий и промахов
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                }
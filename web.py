@@ -0,0 +1,147 @@
+import hashlib
+import hmac
+import json
+import logging
+
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from api import setup_api
+from config_reader import config
+from log_queue import setup_logging
+from metrics import render
+from metrics_store import render_all
+
+
+#
+# Веб-процесс: одно aiohttp-приложение на порту $PORT
+#
+# В режиме вебхука (BOT_MODE=webhook) принимает апдейты обоих ботов,
+# каждого по своему пути, и проверяет секретный заголовок Telegram.
+# Процесс worker из Procfile в этом режиме не нужен: heroku ps:scale worker=0.
+# При WORKERS > 1 апдейты обрабатывают рабочие процессы (см. sharding.py).
+# На /metrics - метрики этого процесса и процессов ботов (см. metrics_store.py),
+# на /api и /dashboard - суммы по сменам для менеджеров (см. api.py).
+#
+
+
+# Путь вебхука бота: по хэшу токена, чтобы сам токен не попадал в логи и адреса
+def webhook_path(name, bot):
+    digest = hashlib.sha256(bot.token.encode()).hexdigest()[:16]
+    return f"/webhook/{name}/{digest}"
+
+
+# Регистрируем вебхук бота в приложении и в Telegram при старте
+def setup_bot_webhook(app, name, dp, bot, secret):
+
+    path = webhook_path(name, bot)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+
+    async def set_webhook() -> None:
+        await bot.set_webhook(config.webhook_base_url.rstrip("/") + path,
+                              secret_token=secret,
+                              allowed_updates=dp.resolve_used_update_types()
+                              )
+        logging.info("Вебхук бота %s установлен", name)
+
+    dp.startup.register(set_webhook)
+    setup_application(app, dp, bot=bot)
+
+
+# Вебхук бота, апдейты которого обрабатывают рабочие процессы (см. sharding.py)
+def setup_sharded_webhook(app, name, dp, bot, secret):
+
+    from sharding import ShardFront
+
+    path = webhook_path(name, bot)
+    front = ShardFront(name, config.workers)
+
+    async def handle(request):
+
+        # Как SimpleRequestHandler: сравнение за постоянное время
+        supplied = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(supplied.encode(), secret.encode()):
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+
+        front.dispatch(update)
+        return web.Response()
+
+    async def start(app):
+        await front.start()
+        await bot.set_webhook(config.webhook_base_url.rstrip("/") + path,
+                              secret_token=secret,
+                              allowed_updates=dp.resolve_used_update_types()
+                              )
+        logging.info("Вебхук бота %s установлен, рабочих процессов: %d", name, config.workers)
+
+    async def stop(app):
+        await front.close()
+        await bot.session.close()
+
+    app.router.add_post(path, handle)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+
+
+# Проверка, что веб-процесс жив
+async def health(request):
+    return web.Response(text="ok")
+
+
+# Метрики веб-процесса и процессов ботов для Prometheus (см. metrics_store.py)
+async def metrics(request):
+    try:
+        text = await render_all()
+    except Exception:
+        logging.exception("Не удалось прочитать метрики процессов ботов")
+        text = render()
+    return web.Response(text=text, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+def create_app():
+
+    app = web.Application()
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics", metrics)
+
+    api_token = config.api_token.get_secret_value() if config.api_token is not None else None
+    setup_api(app, api_token)
+
+    if config.bot_mode == "webhook":
+
+        if not config.webhook_base_url or config.webhook_secret is None:
+            raise ValueError("Для режима вебхука нужны WEBHOOK_BASE_URL и WEBHOOK_SECRET")
+
+        # Боты импортируются только в режиме вебхука
+        import results
+        import sales
+
+        secret = config.webhook_secret.get_secret_value()
+
+        if config.workers > 1:
+            from migrations import migrate_database
+
+            # Схему обновляем один раз до запуска рабочих процессов
+            async def migrate(app):
+                await migrate_database()
+
+            app.on_startup.append(migrate)
+            setup_sharded_webhook(app, "sales", sales.dp, sales.bot, secret)
+            setup_sharded_webhook(app, "results", results.dp, results.bot, secret)
+        else:
+            setup_bot_webhook(app, "sales", sales.dp, sales.bot, secret)
+            setup_bot_webhook(app, "results", results.dp, results.bot, secret)
+
+    return app
+
+
+# Стартуем!
+if __name__ == "__main__":
+    setup_logging()
+    web.run_app(create_app(), port=config.port)
@@ -0,0 +1,143 @@
+import asyncio
+
+from collections import defaultdict
+from database import dialect_insert, dispose_engine, get_async_engine
+from datetime import datetime
+from db_store import Reports, archive_runs, window_totals
+from sqlalchemy import delete, func, insert, inspect, select
+from time_range import TimeRange
+
+
+#
+# Накопительные суммы по временным диапазонам
+#
+# Для каждого диапазона (по началу TimeRange) и магазина хранятся суммы
+# продаж, остатков и количество отчетов. Суммы обновляются при записи
+# отчетов, поэтому сводка за текущий диапазон читается за O(магазинов).
+#
+
+# Таблица отчетов
+reports = Reports.__table__
+
+
+# Добавляем отчеты (дата, магазин, продажи, остатки и, если есть,
+# изменение количества отчетов) к суммам по диапазонам
+def accumulate(totals, rows):
+    for row in rows:
+        date, store, sales, remainings = row[:4]
+        key = (TimeRange.calculate_range(date).start, store or '')
+        item = totals[key]
+        item[0] += sales or 0
+        item[1] += remainings or 0
+        item[2] += row[4] if len(row) > 4 else 1
+    return totals
+
+
+# Строки сумм в порядке ключа: параллельные транзакции (PostgreSQL)
+# блокируют их в одном порядке и не попадают во взаимную блокировку
+def totals_rows(totals):
+    return [dict(window_start=window_start, store=store, sales=sales, remainings=remainings, reports=count)
+            for (window_start, store), (sales, remainings, count) in sorted(totals.items())
+            ]
+
+
+# Обновляем суммы в той же транзакции, в которой записываются отчеты.
+# rows: дата, магазин и изменения продаж, остатков и количества отчетов
+async def apply_totals(db, rows):
+
+    totals = accumulate(defaultdict(lambda: [0, 0, 0]), rows)
+    if not totals:
+        return
+
+    query = dialect_insert(db, window_totals)
+    query = query.on_conflict_do_update(
+        index_elements=[window_totals.c.window_start, window_totals.c.store],
+        set_=dict(sales=window_totals.c.sales + query.excluded.sales,
+                  remainings=window_totals.c.remainings + query.excluded.remainings,
+                  reports=window_totals.c.reports + query.excluded.reports,
+                  )
+    )
+    await db.execute(query, totals_rows(totals))
+
+
+# Суммы по магазинам за диапазон, который начинается в window_start
+async def totals_for_window(db, window_start):
+
+    query = (select(window_totals.c.store,
+                    window_totals.c.sales,
+                    window_totals.c.remainings,
+                    window_totals.c.reports
+                    )
+             .where(window_totals.c.window_start == window_start)
+             .order_by(window_totals.c.store)
+             )
+
+    return (await db.execute(query)).all()
+
+
+# Граница последней архивации (см. archive.py) на синхронном соединении
+def archive_boundary(conn):
+    if not inspect(conn).has_table(archive_runs.name):
+        return None
+    return conn.scalar(select(func.max(archive_runs.c.archived_before)))
+
+
+# Пересчитываем суммы по всем отчетам (синхронное соединение).
+# Отчеты смен до границы архивации перенесены в архив, и их суммы остались
+# только в этой таблице: такие смены не пересчитываются
+def rebuild(conn, chunk_size=10000):
+
+    totals = defaultdict(lambda: [0, 0, 0])
+    boundary = archive_boundary(conn)
+
+    query = select(reports.c.reports_id, reports.c.date, reports.c.store, reports.c.sales, reports.c.remainings)
+    query = query.where(reports.c.date.is_not(None))
+    if boundary is not None:
+        query = query.where(reports.c.date >= boundary)
+
+    # Читаем отчеты частями по возрастанию номера, не загружая всю таблицу
+    # в память. Не курсором: в PostgreSQL он открыт до конца транзакции
+    # миграций и не дает менять схему таблицы
+    last_id = 0
+    while True:
+        rows = conn.execute(query.where(reports.c.reports_id > last_id)
+                            .order_by(reports.c.reports_id)
+                            .limit(chunk_size)
+                            ).all()
+        if not rows:
+            break
+
+        accumulate(totals, [row[1:] for row in rows])
+        last_id = rows[-1].reports_id
+
+    if boundary is None:
+        conn.execute(delete(window_totals))
+    else:
+        conn.execute(delete(window_totals).where(window_totals.c.window_start >= boundary))
+        # После смены графика смена с началом до границы может захватывать
+        # оставшиеся отчеты: ее суммы не трогаем
+        totals = {key: item for key, item in totals.items() if key[0] >= boundary}
+
+    if totals:
+        conn.execute(insert(window_totals), totals_rows(totals))
+
+    return len(totals)
+
+
+# Пересчет сумм из командной строки: python window_totals.py
+async def main():
+
+    from migrations import migrate_database
+
+    try:
+        await migrate_database()
+        async with get_async_engine().begin() as conn:
+            started = datetime.now()
+            count = await conn.run_sync(rebuild)
+        print(f"Пересчитано сумм: {count} за {(datetime.now() - started).total_seconds():.2f} с")
+    finally:
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())